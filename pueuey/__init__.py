@@ -1,4 +1,11 @@
 from conn_adapter import ConnAdapter
+from pool import PooledConnAdapter
 from queue import Queue
+from dispatch import Dispatcher
 from worker import Worker
+from green import GreenWorker
+from reaper import Reaper
+import metrics
+import payloads
+import serializers
 import setup
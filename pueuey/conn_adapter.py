@@ -1,12 +1,16 @@
 import os
+import errno
 import re
 import psycopg2
 import select
+import collections
+import threading
+from contextlib import contextmanager
 import urlparse
 
-from log import log
+from log import log, monotonic
 
-__all__ = ['ConnAdapter']
+__all__ = ['ConnAdapter', 'Subscription']
 
 
 class ConnAdapter(object):
@@ -15,7 +19,12 @@ class ConnAdapter(object):
             % (self.__class__.__name__, id(self),
                repr(self.connection.dsn), self.connection.closed)
 
-    def __init__(self, connection=None):
+    # prepare:: Use server-side prepared statements for the hot queries of
+    #           Queue (there is a fallback if the server refuses them).
+    def __init__(self, connection=None, prepare=None):
+        if prepare is None:
+            prepare = os.environ.get('QC_PREPARE', '1') not in ('0', 'false')
+        self.prepare = prepare
         self.connection = (
             self.__establish_new()
             if connection is None
@@ -23,6 +32,8 @@ class ConnAdapter(object):
         )
         self.connection.set_isolation_level(
             psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.subscription = None
+        self.__cursors = threading.local()
 
     def disconnect(self):
         try:
@@ -32,7 +43,7 @@ class ConnAdapter(object):
             raise
 
     def execute(self, *args):
-        log(at='exec_sql', sql=repr(args[0]))
+        log(at='exec_sql', sql=args[0])
         try:
             with self.connection.cursor() as curs:
                 curs.execute(*args)
@@ -40,29 +51,46 @@ class ConnAdapter(object):
             log(error=repr(e))
             raise
 
+    # Yields a new cursor on the connection. Pooled adapters share this
+    # interface, see PooledConnAdapter#cursor.
+    # reuse:: Yields the same open cursor of cursor_factory to every call of
+    #         a thread instead, which saves its allocation on the hot paths
+    #         (see Queue#lock).
+    @contextmanager
+    def cursor(self, cursor_factory=None, reuse=False):
+        if reuse:
+            yield self.__reused_cursor(cursor_factory)
+            return
+        with self.connection.cursor(cursor_factory=cursor_factory) as curs:
+            yield curs
+
+    def __reused_cursor(self, cursor_factory):
+        cursors = self.__cursors.__dict__
+        curs = cursors.get(cursor_factory)
+        if (curs is None or curs.closed or
+                curs.connection is not self.connection):
+            curs = cursors[cursor_factory] = self.connection.cursor(
+                cursor_factory=cursor_factory)
+        return curs
+
+    @property
+    def server_version(self):
+        return self.connection.server_version
+
+    # Waits at most time seconds for a notification on one of the channels.
+    # The channels are LISTENed once and stay subscribed: notifications
+    # received between two waits are kept and returned immediately, by the
+    # first wait on their channel. See ConnAdapter#subscribe.
     def wait(self, time, *channels):
-        curs = self.connection.cursor()
-        listen_cmds = ['LISTEN "%s"' % c for c in channels]
-        curs.execute(';'.join(listen_cmds))
-        channel = self.__wait_for_notify(time)
-        unlisten_cmds = ['UNLISTEN "%s"' % c for c in channels]
-        curs.execute(';'.join(unlisten_cmds))
-        self.__drain_notify()
-        return channel
-
-    def __drain_notify(self):
-        notifies = list(self.connection.notifies)
-        if notifies:
-            log(at='drain_notifications')
-            del self.connection.notifies[:]
-        return notifies
+        return self.subscribe(*channels).wait(time, *channels)
 
-    def __wait_for_notify(self, t):
-        if any(select.select([self.connection], [], [], t)):
-            self.connection.poll()
-            if self.connection.notifies:
-                return self.connection.notifies.pop()
-        return None
+    # Returns the Subscription of the connection after making sure it
+    # listens to the channels.
+    def subscribe(self, *channels):
+        if self.subscription is None:
+            self.subscription = Subscription(self.connection)
+        self.subscription.listen(*channels)
+        return self.subscription
 
     def __validate(self, connection):
         assert isinstance(connection, psycopg2._psycopg.connection), \
@@ -100,3 +128,78 @@ class ConnAdapter(object):
         if not url:
             raise ValueError("missing QC_DATABASE_URL or DATABASE_URL")
         return urlparse.urlparse(url)
+
+
+# A Subscription LISTENs to channels once for the lifetime of a connection
+# and buffers the notifications it receives, including the ones psycopg2
+# collects while other queries are executed on the connection.
+class Subscription(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.channels = set()
+        self.notifies = collections.deque()
+
+    def listen(self, *channels):
+        channels = [c for c in channels if c not in self.channels]
+        if channels:
+            log(at='listen', channels=','.join(channels))
+            with self.connection.cursor() as curs:
+                curs.execute(';'.join(['LISTEN "%s"' % c for c in channels]))
+            self.channels.update(channels)
+
+    def unlisten(self, *channels):
+        channels = [c for c in channels if c in self.channels]
+        if channels:
+            log(at='unlisten', channels=','.join(channels))
+            with self.connection.cursor() as curs:
+                curs.execute(
+                    ';'.join(['UNLISTEN "%s"' % c for c in channels]))
+            self.channels.difference_update(channels)
+            self.poll()
+            self.notifies = collections.deque(
+                n for n in self.notifies if n.channel in self.channels)
+
+    # Moves the notifications received by the connection to the buffer,
+    # without blocking. Returns the number of notifications buffered.
+    def poll(self):
+        self.connection.poll()
+        if self.connection.notifies:
+            self.notifies.extend(self.connection.notifies)
+            del self.connection.notifies[:]
+        return len(self.notifies)
+
+    # Drops the buffered notifications.
+    def clear(self):
+        self.poll()
+        if self.notifies:
+            log(at='drain_notifications')
+            self.notifies.clear()
+
+    # Returns the first buffered notification on one of the channels (on any
+    # channel listened to if none is given), or waits at most time seconds
+    # for one, and drops the others on these channels. The notifications on
+    # other channels stay buffered. Returns None on timeout.
+    def wait(self, time, *channels):
+        channels = set(channels) if channels else self.channels
+        deadline = None if time is None else monotonic() + time
+        self.poll()
+        while not any(n.channel in channels for n in self.notifies):
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            try:
+                ready = select.select([self.connection], [], [], remaining)
+            except select.error, e:
+                # interrupted by a signal: let the caller check its state
+                if e.args[0] != errno.EINTR:
+                    raise
+                return None
+            if not any(ready):
+                return None
+            self.poll()
+        notifies = [n for n in self.notifies if n.channel in channels]
+        if len(notifies) > 1:
+            log(at='drain_notifications')
+        self.notifies = collections.deque(
+            n for n in self.notifies if n.channel not in channels)
+        return notifies[0]
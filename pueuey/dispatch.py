@@ -0,0 +1,77 @@
+import os
+import threading
+import importlib
+import collections
+
+from log import log
+
+__all__ = ['Dispatcher']
+
+
+# A Dispatcher resolves the method string of a job to a callable.
+# Callables can be registered explicitly under a name with Dispatcher#task,
+# otherwise the method string is resolved by importing the module before
+# the last `.` and getting the attribute after it (or the attribute of
+# __main__ if there is no `.`). Resolved callables are kept in a LRU cache
+# of cache_size entries. The dispatcher can be shared between threads.
+class Dispatcher(object):
+    def __init__(self, cache_size=None, package=None):
+        if cache_size is None:
+            cache_size = int(os.environ.get('QC_DISPATCH_CACHE', '1024'))
+        self.cache_size, self.package = cache_size, package
+        self.tasks = {}
+        self.cache = collections.OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    # Registers a callable under a name, to use as a decorator:
+    #   @dispatcher.task("mail.send")
+    #   def send(to, subject): ...
+    def task(self, name):
+        def register(func):
+            with self.lock:
+                self.tasks[name] = func
+                self.cache.pop(name, None)
+            return func
+        return register
+
+    def resolve(self, method):
+        with self.lock:
+            func = self.tasks.get(method)
+            if func is None:
+                func = self.cache.pop(method, None)
+                if func is not None:
+                    self.cache[method] = func
+            if func is not None:
+                self.hits += 1
+                return func
+            self.misses += 1
+        func = self.__import(method)
+        with self.lock:
+            self.cache[method] = func
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return func
+
+    # Resolves the methods in advance, for example when the worker starts.
+    def prewarm(self, methods):
+        for method in methods:
+            log(at="prewarm", method=method)
+            self.resolve(method)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.cache),
+            'tasks': len(self.tasks),
+        }
+
+    def __import(self, method):
+        receiver_str, _, message = method.rpartition('.')
+        if receiver_str:
+            module = importlib.import_module(receiver_str, self.package)
+        else:
+            import __main__
+            module = __main__
+        return getattr(module, message)
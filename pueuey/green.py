@@ -0,0 +1,131 @@
+import os
+import collections
+import psycopg2
+import psycopg2.extensions
+
+try:
+    import gevent
+    import gevent.event
+    import gevent.pool
+    from gevent.socket import wait_read, wait_write
+except ImportError:
+    gevent = None
+
+from log import log, monotonic
+from conn_adapter import ConnAdapter
+from worker import Worker
+
+__all__ = ['GreenWorker', 'patch_psycopg']
+
+
+# Wait callback making psycopg2 cooperative with gevent: libpq is used in
+# non-blocking mode and the current greenlet yields to the hub while the
+# connection is not ready.
+def gevent_wait_callback(conn, timeout=None):
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(
+                "Bad result from poll: %r" % state)
+
+# Makes all the psycopg2 connections of the process cooperative.
+# Does nothing if a wait callback has already been registered.
+def patch_psycopg():
+    if gevent is None:
+        raise ImportError("gevent is required to use pueuey.green")
+    if psycopg2.extensions.get_wait_callback() is None:
+        psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+
+
+# A GreenWorker runs many jobs concurrently in greenlets, for I/O-bound
+# jobs that use cooperative (gevent) libraries.
+# A single dispatcher greenlet locks, deletes and unlocks the jobs on the
+# worker's connection and a listener greenlet keeps one LISTEN on all the
+# queues on a second connection, so a handful of connections is enough
+# for hundreds of jobs in flight.
+class GreenWorker(Worker):
+
+    # Takes the same arguments as Worker plus:
+    # concurrency:: Maximum number of jobs running at the same time.
+    def __init__(self, concurrency=None, **kwargs):
+        patch_psycopg()
+        if concurrency is None:
+            concurrency = int(os.environ.get('QC_CONCURRENCY', '100'))
+        self.concurrency = concurrency
+        super(GreenWorker, self).__init__(**kwargs)
+
+    # Dispatches jobs until the worker is stopped, then waits for the jobs
+    # in flight to finish.
+    def start(self):
+        self.dispatcher.prewarm(self.prewarm)
+        self.__wakeup = gevent.event.Event()
+        self.__results = collections.deque()
+        pool = gevent.pool.Pool(self.concurrency)
+        listener = gevent.spawn(self.__listen)
+        log(at="green_start", concurrency=self.concurrency)
+        try:
+            self.start_heartbeat()
+            while self.running:
+                self.__collect()
+                locked = self.try_lock_job() if pool.free_count() else None
+                if locked:
+                    self.flush_expired()
+                    pool.spawn(self.__run, *locked)
+                    continue
+                self.flush_completed()
+                self.__wakeup.wait(self.wait_time() if pool.free_count()
+                                   else self.wait_interval)
+                self.__wakeup.clear()
+        finally:
+            self.running = False
+            listener.kill()
+            pool.join()
+            self.__collect()
+            self.flush_completed()
+            self.unlock_prefetched()
+            self.stop_heartbeat()
+
+    def __run(self, queue, job):
+        log(at="work", job=job['id'])
+        start = monotonic()
+        try:
+            self.call(job)
+        except Exception, e:
+            self.__results.append((queue, job, e))
+        else:
+            self.__results.append((queue, job, None))
+        finally:
+            self.metrics.timing('qc.time-to-process', monotonic() - start,
+                                source=queue.name)
+            self.__wakeup.set()
+
+    # Deletes the finished jobs and reports the failures, in the dispatcher
+    # greenlet which owns the worker's connection.
+    def __collect(self):
+        while self.__results:
+            queue, job, e = self.__results.popleft()
+            if e is None:
+                self.complete(queue, job['id'])
+            else:
+                self.handle_failure(job, e)
+
+    def __listen(self):
+        conn_adapter = ConnAdapter(self.new_connection())
+        connection = conn_adapter.connection
+        try:
+            subscription = conn_adapter.subscribe(
+                *[queue.name for queue in self.queues])
+            while True:
+                wait_read(connection.fileno())
+                if subscription.poll():
+                    self.due_at = None
+                    subscription.clear()
+                    self.__wakeup.set()
+        finally:
+            conn_adapter.disconnect()
@@ -1,22 +1,85 @@
-import datetime
+import os
+import time
 import logging
 from contextlib import contextmanager
 
 
 _logger = logging.getLogger('pueuey')
 
+# Set QC_INSTRUMENT=0 to remove the logging instrumentation of the hot paths
+# of Queue and Worker: log() and log_yield() are then no-ops, whatever the
+# level of the logger.
+instrument = os.environ.get('QC_INSTRUMENT', '1') not in ('0', 'false')
+
+def _monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 1
+        clock_gettime = ctypes.CDLL(
+            ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+            use_errno=True).clock_gettime
+
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t.tv_sec + t.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (ImportError, AttributeError, TypeError, OSError):
+        return time.time
+
+# Returns the time in seconds of a clock which can not go backwards (it
+# falls back on time.time when clock_gettime is not available).
+monotonic = _monotonic()
+
+# The values are only formatted if the logger is enabled for DEBUG.
 def log(**data):
+    if not _logger.isEnabledFor(logging.DEBUG):
+        return
     data = dict(data, lib='pueuey')
-    _logger.debug(" ".join([(k + '=' + v) for k, v in data.items()]))
+    _logger.debug(" ".join(["%s=%s" % (k, v) for k, v in data.items()]))
+
+class _Nothing(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+_nothing = _Nothing()
 
 @contextmanager
-def log_yield(**data):
+def _log_yield(data):
     try:
-        t0 = datetime.datetime.now()
+        t0 = monotonic()
         yield
     except Exception, e:
         log(**dict(data, at='error', error=repr(e)))
         raise
     else:
-        t = int((datetime.datetime.now() - t0).microseconds / 1000)
+        t = int((monotonic() - t0) * 1000)
         log(**dict(data, elapsed=(str(t) + 'ms')))
+
+# Logs the time spent in the block (and the exception raised if any).
+# Nothing is measured if the logger is not enabled for DEBUG.
+def log_yield(**data):
+    if not _logger.isEnabledFor(logging.DEBUG):
+        return _nothing
+    return _log_yield(data)
+
+if not instrument:
+    def log(**data):
+        pass
+
+    def log_yield(**data):
+        return _nothing
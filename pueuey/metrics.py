@@ -0,0 +1,222 @@
+import os
+import re
+import socket
+import logging
+import threading
+import collections
+
+from log import _logger, monotonic
+
+__all__ = ['Metrics', 'LoggingMetrics', 'MemoryMetrics', 'StatsdMetrics',
+           'PrometheusTextfileMetrics', 'get_default', 'set_default']
+
+
+# Metrics is the interface of the metrics sinks used by Queue and Worker.
+# It also is a sink which discards everything.
+# The metrics recorded are:
+# qc.enqueue:: counter, jobs enqueued
+# qc.lock:: counter, jobs locked
+# qc.time-to-lock:: timing, time between the creation and the lock of a job
+# qc.time-to-process:: timing, time spent processing a job
+# qc.job-error:: counter, jobs which raised an exception
+# qc.idle-wait:: timing, time a worker waited for a notification
+# qc.reaped:: counter, jobs unlocked by a Reaper
+# qc.top-bound:: gauge, top_bound of a queue with an AdaptiveTopBound
+# All of them are tagged with the name of the queue (source), except
+# qc.idle-wait and the count of qc.reaped for the jobs of dead workers.
+# Timings are given in seconds.
+# The sinks must be thread-safe.
+class Metrics(object):
+    def increment(self, name, value=1, **tags):
+        pass
+
+    def timing(self, name, seconds, **tags):
+        pass
+
+    def gauge(self, name, value, **tags):
+        pass
+
+
+# Writes the metrics to the pueuey logger (at INFO level) using the l2met
+# conventions: count#name=value, measure#name=valuems and sample#name=value.
+class LoggingMetrics(Metrics):
+    def increment(self, name, value=1, **tags):
+        self.__log("count", name, value, tags)
+
+    def timing(self, name, seconds, **tags):
+        self.__log("measure", name, "%.3fms" % (seconds * 1000), tags)
+
+    def gauge(self, name, value, **tags):
+        self.__log("sample", name, value, tags)
+
+    def __log(self, kind, name, value, tags):
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info(" ".join(
+                ["%s#%s=%s" % (kind, name, value)] +
+                ["%s=%s" % tag for tag in sorted(tags.items())]))
+
+
+# Keeps the metrics in memory, for the tests.
+# counters and gauges map (name, tags) to a number, timings map
+# (name, tags) to the list of the values observed. tags is a sorted tuple
+# of (key, value) pairs.
+class MemoryMetrics(Metrics):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = collections.defaultdict(int)
+            self.timings = collections.defaultdict(list)
+            self.gauges = {}
+
+    def increment(self, name, value=1, **tags):
+        with self.lock:
+            self.counters[name, tuple(sorted(tags.items()))] += value
+
+    def timing(self, name, seconds, **tags):
+        with self.lock:
+            self.timings[name, tuple(sorted(tags.items()))].append(seconds)
+
+    def gauge(self, name, value, **tags):
+        with self.lock:
+            self.gauges[name, tuple(sorted(tags.items()))] = value
+
+    # Sum of a counter for all the tags.
+    def count(self, name):
+        with self.lock:
+            return sum(v for (n, tags), v in self.counters.items()
+                       if n == name)
+
+
+# Sends the metrics to a statsd daemon over UDP. Tags are sent with the
+# DogStatsD syntax unless tags is False, timings are sent in milliseconds.
+class StatsdMetrics(Metrics):
+    def __init__(self, host=None, port=None, prefix=None, tags=True):
+        if host is None:
+            host = os.environ.get('QC_STATSD_HOST', 'localhost')
+        if port is None:
+            port = int(os.environ.get('QC_STATSD_PORT', '8125'))
+        if prefix is None:
+            prefix = os.environ.get('QC_STATSD_PREFIX', '')
+        self.address, self.prefix, self.tags = (host, port), prefix, tags
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def increment(self, name, value=1, **tags):
+        self.__send(name, value, 'c', tags)
+
+    def timing(self, name, seconds, **tags):
+        self.__send(name, "%.3f" % (seconds * 1000), 'ms', tags)
+
+    def gauge(self, name, value, **tags):
+        self.__send(name, value, 'g', tags)
+
+    def __send(self, name, value, kind, tags):
+        data = "%s%s:%s|%s" % (self.prefix, name, value, kind)
+        if self.tags and tags:
+            data += "|#" + ",".join(["%s:%s" % tag
+                                     for tag in sorted(tags.items())])
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            # metrics must never break the queue
+            pass
+
+
+# Writes the metrics in the Prometheus text format to path, for the
+# textfile collector of node_exporter. Timings are histograms in seconds.
+# The file is written atomically, at most every interval seconds, and by
+# flush(). path may contain %(pid)s so forked processes use their own file.
+class PrometheusTextfileMetrics(Metrics):
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+
+    def __init__(self, path, interval=10, prefix='pueuey_'):
+        self.path, self.interval, self.prefix = path, interval, prefix
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.gauges = {}
+        self.written = monotonic()
+
+    def increment(self, name, value=1, **tags):
+        with self.lock:
+            self.counters[self.__key(name + '_total', tags)] += value
+        self.__maybe_flush()
+
+    def timing(self, name, seconds, **tags):
+        with self.lock:
+            key = self.__key(name + '_seconds', tags)
+            counts, total = self.histograms.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.histograms[key] = (counts, total + seconds)
+        self.__maybe_flush()
+
+    def gauge(self, name, value, **tags):
+        with self.lock:
+            self.gauges[self.__key(name, tags)] = value
+        self.__maybe_flush()
+
+    def flush(self):
+        with self.lock:
+            path = self.path % {'pid': os.getpid()}
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, 'w') as fh:
+                fh.write("\n".join(self.__format()) + "\n")
+            os.rename(tmp, path)
+            self.written = monotonic()
+
+    def __maybe_flush(self):
+        if monotonic() - self.written >= self.interval:
+            self.flush()
+
+    def __key(self, name, tags):
+        name = self.prefix + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        return (name, tuple(sorted(tags.items())))
+
+    def __labels(self, tags, extra=()):
+        tags = list(tags) + list(extra)
+        if not tags:
+            return ''
+        return '{%s}' % ','.join(['%s="%s"' % tag for tag in tags])
+
+    def __format(self):
+        lines = []
+        for kind, values in (('counter', self.counters),
+                             ('gauge', self.gauges)):
+            for name in sorted(set(n for n, tags in values)):
+                lines.append("# TYPE %s %s" % (name, kind))
+                for (n, tags), value in sorted(values.items()):
+                    if n == name:
+                        lines.append("%s%s %s"
+                                     % (name, self.__labels(tags), value))
+        for name in sorted(set(n for n, tags in self.histograms)):
+            lines.append("# TYPE %s histogram" % name)
+            for (n, tags), (counts, total) in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+                for bound, count in zip(bounds, counts):
+                    lines.append("%s_bucket%s %d" % (
+                        name, self.__labels(tags, [('le', bound)]), count))
+                lines.append("%s_sum%s %s"
+                             % (name, self.__labels(tags), total))
+                lines.append("%s_count%s %d"
+                             % (name, self.__labels(tags), counts[-1]))
+        return lines
+
+
+_default = LoggingMetrics()
+
+# Returns the sink used by the Queue and Worker objects created without an
+# explicit one.
+def get_default():
+    return _default
+
+def set_default(metrics):
+    global _default
+    _default = metrics
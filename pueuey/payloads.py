@@ -0,0 +1,111 @@
+import os
+import time
+import errno
+import tempfile
+
+__all__ = ['PayloadStore', 'TablePayloadStore', 'FilePayloadStore',
+           'get_default']
+
+
+# A PayloadStore keeps the encoded args of the jobs whose payload is too
+# large to be stored in the jobs table (see the payload_threshold option of
+# Queue). The payloads are stored under the id of their job, right after
+# the job is inserted (see FilePayloadStore for the transactions), and
+# fetched only once the job has been locked: the jobs table stays narrow
+# and the lock functions do not ship the payloads. Its subclasses
+# implement:
+# put(curs, id, payload):: Stores the payload (a str) of the job id.
+# get(curs, id):: Returns the payload of the job id.
+# delete(curs, ids):: Deletes the payloads of the jobs ids (if any).
+# The methods are given a cursor of the queue's connection.
+class PayloadStore(object):
+    pass
+
+
+# Stores the payloads in the queue_classic_payloads table.
+class TablePayloadStore(PayloadStore):
+    def put(self, curs, id, payload):
+        curs.execute('INSERT INTO queue_classic_payloads (job_id, data) '
+                     'VALUES (%s, %s)', [id, buffer(payload)])
+
+    def get(self, curs, id):
+        curs.execute('SELECT data FROM queue_classic_payloads '
+                     'WHERE job_id = %s', [id])
+        return str(curs.fetchone()[0])
+
+    def delete(self, curs, ids):
+        curs.execute('DELETE FROM queue_classic_payloads '
+                     'WHERE job_id = ANY(%s)', [list(ids)])
+
+
+# Stores the payloads in files of a directory, which must be shared by the
+# producers and the workers (a local directory for the workers of a single
+# host, or a network file system). The files are written atomically, but
+# outside of the transaction which inserts the job: Queue deletes them when
+# it rolls its transaction back, the files of a transaction of the
+# application which is rolled back are deleted by FilePayloadStore#sweep.
+class FilePayloadStore(PayloadStore):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __path(self, id):
+        return os.path.join(self.directory, '%d.payload' % id)
+
+    def put(self, curs, id, payload):
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.rename(path, self.__path(id))
+        except:
+            os.unlink(path)
+            raise
+
+    def get(self, curs, id):
+        with open(self.__path(id), 'rb') as f:
+            return f.read()
+
+    def delete(self, curs, ids):
+        for id in ids:
+            try:
+                os.unlink(self.__path(id))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    # Deletes the payloads older than age seconds whose job is neither in
+    # the jobs tables nor in queue_classic_failed_jobs (the payload of a job
+    # whose transaction was rolled back). Returns the number of payloads
+    # deleted. It should run periodically, with an age longer than the
+    # longest transaction enqueuing jobs.
+    def sweep(self, curs, age=3600):
+        deadline = time.time() - age
+        ids = []
+        for name in os.listdir(self.directory):
+            id, ext = os.path.splitext(name)
+            if ext != '.payload' or not id.isdigit():
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self.directory, name)) \
+                        < deadline:
+                    ids.append(int(id))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        if not ids:
+            return 0
+        curs.execute('SELECT id FROM queue_classic_jobs '
+                     'WHERE id = ANY(%s) UNION ALL '
+                     'SELECT id FROM queue_classic_failed_jobs '
+                     'WHERE id = ANY(%s)', [ids, ids])
+        orphans = set(ids).difference(row[0] for row in curs.fetchall())
+        self.delete(curs, orphans)
+        return len(orphans)
+
+
+# Returns a FilePayloadStore on the directory QC_PAYLOAD_DIR if it is set,
+# a TablePayloadStore otherwise.
+def get_default():
+    if os.environ.get('QC_PAYLOAD_DIR'):
+        return FilePayloadStore(os.environ['QC_PAYLOAD_DIR'])
+    return TablePayloadStore()
@@ -0,0 +1,187 @@
+import os
+import time
+import threading
+import psycopg2
+import psycopg2.pool
+from contextlib import contextmanager
+
+from log import log
+from conn_adapter import ConnAdapter
+
+__all__ = ['PooledConnAdapter']
+
+
+# A PooledConnAdapter has the same interface as ConnAdapter to execute
+# queries but checks out a connection from a pool for each operation, so
+# many Queue objects (and threads) can share a few connections.
+# minconn connections are established when the pool is created, the
+# others lazily, up to maxconn of them, and at most max_idle idle
+# connections are kept open. The pool is emptied when it is used in a
+# process forked after the connections were established, and starts over
+# with lazily established connections.
+# LISTEN needs a dedicated connection: use a ConnAdapter to wait for jobs.
+class PooledConnAdapter(object):
+    __shared = None
+    __shared_lock = threading.Lock()
+
+    def __str__(self):
+        return "<%s object at 0x%x; idle: %d, used: %d, maxconn: %d>" \
+            % (self.__class__.__name__, id(self),
+               len(self.idle), self.used, self.maxconn)
+
+    # minconn:: Number of connections established up front.
+    # maxconn:: Maximum number of connections, checkout() blocks when they
+    #           are all in use.
+    # connect:: Function returning a new psycopg2 connection, by default the
+    #           connection is established like ConnAdapter does.
+    # timeout:: Maximum time to wait for a connection, None waits forever.
+    # check_interval:: Idle time (in seconds) after which a connection is
+    #                  checked with a query before being used.
+    # prepare:: Use prepared statements, see ConnAdapter.
+    # max_idle:: Maximum number of idle connections kept open, maxconn by
+    #            default: a connection closed loses its prepared statements.
+    def __init__(self, minconn=None, maxconn=None, connect=None,
+                 timeout=None, check_interval=None, prepare=None,
+                 max_idle=None):
+        if minconn is None:
+            minconn = int(os.environ.get('QC_POOL_MIN', '0'))
+        if maxconn is None:
+            maxconn = int(os.environ.get('QC_POOL_MAX', '10'))
+        if max_idle is None:
+            max_idle = int(os.environ.get('QC_POOL_MAX_IDLE', maxconn))
+        if not minconn <= max_idle <= maxconn:
+            raise ValueError("minconn <= max_idle <= maxconn is required")
+        if check_interval is None:
+            check_interval = float(os.environ.get('QC_POOL_CHECK', '30'))
+        if prepare is None:
+            prepare = os.environ.get('QC_PREPARE', '1') not in ('0', 'false')
+        self.minconn, self.maxconn = minconn, maxconn
+        self.max_idle = max_idle
+        self.connect, self.timeout = connect, timeout
+        self.check_interval = check_interval
+        self.prepare = prepare
+        self.lock = threading.Condition(threading.Lock())
+        self.__inherited = []
+        self.__reset()
+        for i in range(minconn):
+            self.idle.append((self.__establish_new(), time.time()))
+
+    # Returns the pool shared by default by the Queue objects.
+    @classmethod
+    def shared(cls):
+        with cls.__shared_lock:
+            if cls.__shared is None:
+                cls.__shared = cls()
+            return cls.__shared
+
+    def __reset(self):
+        self.pid = os.getpid()
+        self.idle = []
+        self.used = 0
+        self.__server_version = None
+
+    def __check_fork(self):
+        if self.pid != os.getpid():
+            log(at='pool_forked')
+            # NOTE: the connections of the parent process must not be
+            #       closed (nor garbage collected) by the child process
+            self.__inherited.extend(self.idle)
+            self.__reset()
+
+    # Returns a connection of the pool, establishing a new one if
+    # there is no idle connection and less than maxconn are in use.
+    def checkout(self):
+        with self.lock:
+            self.__check_fork()
+            deadline = (None if self.timeout is None
+                        else time.time() + self.timeout)
+            while not self.idle and self.used >= self.maxconn:
+                remaining = (None if deadline is None
+                             else deadline - time.time())
+                if remaining is not None and remaining <= 0:
+                    raise psycopg2.pool.PoolError("connection pool exhausted")
+                self.lock.wait(remaining)
+            self.used += 1
+            idle = self.idle.pop() if self.idle else None
+        try:
+            connection = self.__check(idle) if idle else None
+            if connection is None:
+                connection = self.__establish_new()
+        except:
+            with self.lock:
+                self.used -= 1
+                self.lock.notify()
+            raise
+        return connection
+
+    # Gives a connection back to the pool. It is closed if it is broken or
+    # if max_idle connections are already idle.
+    def checkin(self, connection):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.__inherited.append(connection)
+                return
+            self.used -= 1
+            self.lock.notify()
+            if not connection.closed and len(self.idle) < self.max_idle:
+                status = connection.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    self.idle.append((connection, time.time()))
+                    return
+        log(at='pool_discard')
+        if not connection.closed:
+            connection.close()
+
+    # Checks a connection out for the duration of the with block. Unlike
+    # ConnAdapter, a pool has no connection attribute.
+    @contextmanager
+    def checkout_connection(self):
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+    # The cursors are never reused (see ConnAdapter#cursor): each call may
+    # check out a different connection.
+    @contextmanager
+    def cursor(self, cursor_factory=None, reuse=False):
+        with self.checkout_connection() as connection:
+            with connection.cursor(cursor_factory=cursor_factory) as curs:
+                yield curs
+
+    def execute(self, *args):
+        with self.checkout_connection() as connection:
+            ConnAdapter(connection).execute(*args)
+
+    @property
+    def server_version(self):
+        if self.__server_version is None:
+            with self.checkout_connection() as connection:
+                self.__server_version = connection.server_version
+        return self.__server_version
+
+    # Closes the idle connections.
+    def disconnect(self):
+        with self.lock:
+            self.__check_fork()
+            idle, self.idle = self.idle, []
+        for connection, since in idle:
+            connection.close()
+
+    def __check(self, idle):
+        connection, since = idle
+        if connection.closed:
+            return None
+        if time.time() - since >= self.check_interval:
+            try:
+                with connection.cursor() as curs:
+                    curs.execute("SELECT 1")
+            except psycopg2.Error, e:
+                log(at='pool_check', error=repr(e))
+                connection.close()
+                return None
+        return connection
+
+    def __establish_new(self):
+        return ConnAdapter(self.connect() if self.connect else None).connection
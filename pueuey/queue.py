@@ -1,41 +1,282 @@
 import os
+import re
 import sys
+import logging
+import weakref
+import hashlib
 import itertools
 import datetime
 import psycopg2
 import psycopg2.extras
-import json
+import psycopg2.errorcodes
+from contextlib import contextmanager
 
-from log import log, log_yield, _logger
+from log import log, log_yield, monotonic, _logger
 from conn_adapter import ConnAdapter
+from pool import PooledConnAdapter
+from metrics import get_default as get_default_metrics
+from serializers import get_default as get_default_serializer
+from payloads import get_default as get_default_payload_store
 import setup
 
-__all__ = ['Queue']
+__all__ = ['Queue', 'Job', 'AdaptiveTopBound']
 
 
 class LoggingCursor(psycopg2.extensions.cursor):
+    # names of the statements prepared on each connection, None when the
+    # connection does not support prepared statements
+    prepared = weakref.WeakKeyDictionary()
+
     def execute(self, sql, args=None):
-        log(at='exec_sql', sql=self.mogrify(sql, args))
+        if _logger.isEnabledFor(logging.DEBUG):
+            log(at='exec_sql', sql=self.mogrify(sql, args))
         try:
             super(LoggingCursor, self).execute(sql, args)
         except Exception, exc:
             log(error=repr(exc))
             raise
 
+    # Executes sql (using %s placeholders) as the prepared statement name.
+    # The statement is prepared the first time it is used on the
+    # connection. If it can not be prepared, or if it is not found when it
+    # is executed (behind a pooler which does not keep the sessions, the
+    # PREPARE and the EXECUTE may reach different server connections), sql
+    # is executed as is from then on.
+    def execute_prepared(self, name, sql, args=None):
+        prepared = self.prepared.setdefault(self.connection, set())
+        if prepared is not None and name not in prepared:
+            try:
+                self.execute(_prepare(name, sql))
+                prepared.add(name)
+            except psycopg2.Error, exc:
+                log(at='prepare', error=repr(exc))
+                prepared = self.prepared[self.connection] = None
+        if prepared is None:
+            return self.execute(sql, args)
+        try:
+            return self.execute(_execute(name, sql), args)
+        except psycopg2.Error, exc:
+            if (exc.pgcode !=
+                    psycopg2.errorcodes.INVALID_SQL_STATEMENT_NAME):
+                raise
+            self.prepared[self.connection] = None
+            return self.execute(sql, args)
+
 class LoggingRealDictCursor(LoggingCursor, psycopg2.extras.RealDictCursor):
     pass
 
+# Returns json values as strings, to be decoded by the serializer of the
+# queue instead of the json module.
+_JSON_TEXT = psycopg2.extensions.new_type((114,), 'JSON_TEXT',
+                                          lambda value, curs: value)
+
+# Cursor used to lock jobs, see Queue#lock.
+class LoggingJobCursor(LoggingCursor):
+    def __init__(self, *args, **kwargs):
+        super(LoggingJobCursor, self).__init__(*args, **kwargs)
+        psycopg2.extensions.register_type(_JSON_TEXT, self)
+
+_statements = {}
+
+def _prepare(name, sql):
+    if ('PREPARE', name) not in _statements:
+        counter = itertools.count(1)
+        _statements['PREPARE', name] = 'PREPARE %s AS %s' % (
+            name, re.sub(r'%s', lambda m: '$%d' % next(counter), sql))
+    return _statements['PREPARE', name]
+
+def _execute(name, sql):
+    if ('EXECUTE', name) not in _statements:
+        _statements['EXECUTE', name] = 'EXECUTE %s(%s)' % (
+            name, ', '.join(['%s'] * sql.count('%s')))
+    return _statements['EXECUTE', name]
+
+# Columns returned by the lock functions: the ones needed to decode and run
+# the jobs, and the time the job waited since it was due (enqueued, or
+# scheduled by run_at or a retry backoff) before being locked, computed by
+# the server so it does not depend on the clock of the client.
+_LOCK_COLUMNS = ('id, q_name, method, args, data, external, created_at, '
+                 'extract(epoch FROM now() - '
+                 'greatest(created_at, run_at))::float8')
+
+# A locked job, as returned by Queue#lock. Its fields can also be read as
+# items (job['id']), like the dicts the jobs used to be.
+class Job(object):
+    __slots__ = ('id', 'q_name', 'method', 'args', 'created_at')
+
+    def __init__(self, id, q_name, method, args, created_at):
+        self.id, self.q_name, self.method = id, q_name, method
+        self.args, self.created_at = args, created_at
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __repr__(self):
+        return '<Job %s %s %s>' % (self.id, self.q_name, self.method)
+
+# An adaptive top_bound, used by Queue when top_bound is 'auto' (or
+# QC_TOP_BOUND=auto). lock_head spreads the workers over the top_bound
+# first jobs of the queue: 1 is strict FIFO but makes the workers collide
+# on the head of the queue, each collision costing a retry in lock_head.
+# The bound is never lower than the number of workers registered on the
+# queue (see Worker#start_heartbeat), so a single worker stays strictly
+# FIFO. Every window locks it is doubled if the average latency of the
+# locks rose above twice the lowest average observed (the retries slow the
+# locks down), and decreased by one once the latency is back to that level.
+# maximum:: Upper limit of the bound (QC_MAX_TOP_BOUND, 100 by default).
+class AdaptiveTopBound(object):
+    def __init__(self, maximum=None, window=20, alpha=0.1):
+        if maximum is None:
+            maximum = int(os.environ.get('QC_MAX_TOP_BOUND', '100'))
+        self.maximum, self.window, self.alpha = maximum, window, alpha
+        self.workers = 1
+        self.value = 1
+        self.latency = self.baseline = None
+        self.observed = 0
+
+    def __int__(self):
+        return max(self.value, min(self.workers, self.maximum))
+
+    # Records the latency of a successful lock. Returns True when the bound
+    # was reconsidered, at the end of a window.
+    def observe(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+        # the lowest average drifts up slowly, to follow a slower server
+        if self.baseline is None or self.latency < self.baseline:
+            self.baseline = self.latency
+        else:
+            self.baseline *= 1.001
+        self.observed += 1
+        if self.observed % self.window:
+            return False
+        value = int(self)
+        if self.latency > 2 * self.baseline:
+            value *= 2
+        elif self.latency < 1.25 * self.baseline:
+            value -= 1
+        self.value = max(1, min(self.maximum, value))
+        return True
+
+# The run_at column of the jobs is inserted as
+# coalesce(%s::timestamptz, now()) + %s::interval
+_RUN_AT = 'coalesce(%s::timestamptz, now()) + %s::interval'
+
+# Returns the two parameters of _RUN_AT: a datetime is used as is, a
+# timedelta or a number of seconds is added to the time of the insertion.
+def _run_at(run_at):
+    if run_at is None or isinstance(run_at, datetime.datetime):
+        return [run_at, datetime.timedelta(0)]
+    if not isinstance(run_at, datetime.timedelta):
+        run_at = datetime.timedelta(seconds=run_at)
+    return [None, run_at]
+
 # The queue class maps a queue abstraction onto a database table.
 class Queue(object):
-    def __init__(self, name, top_bound=None):
+    chunk_size = int(os.environ.get('QC_CHUNK_SIZE', '1000'))
+
+    # skip_locked:: Lock jobs using lock_head_skip_locked (FOR UPDATE SKIP
+    #               LOCKED) instead of lock_head. None means it is used when
+    #               the server supports it (PostgreSQL 9.5 or later).
+    # metrics:: Metrics sink, by default the one given by
+    #           pueuey.metrics.get_default().
+    # serializer:: Serializer of the args of the jobs, by default the one
+    #              given by pueuey.serializers.get_default().
+    # payload_threshold:: Size in bytes from which the encoded args of a job
+    #                     are stored out of line in payload_store instead of
+    #                     the jobs table (QC_PAYLOAD_THRESHOLD, 0 disables
+    #                     it, the default).
+    # payload_store:: Store of these payloads, by default the one given by
+    #                 pueuey.payloads.get_default().
+    # top_bound:: Number of jobs at the head of the queue lock_head picks
+    #             from (QC_TOP_BOUND, 9 by default), or 'auto' for an
+    #             AdaptiveTopBound. Not used with skip_locked. The number
+    #             of workers on the queue, below which an AdaptiveTopBound
+    #             never goes, is only counted by the workers which send
+    #             heartbeats (see Worker#start_heartbeat), it is 1 otherwise.
+    def __init__(self, name, top_bound=None, skip_locked=None, metrics=None,
+                 serializer=None, payload_threshold=None, payload_store=None):
         if top_bound is None:
-            top_bound = os.environ.get('QC_TOP_BOUND', 9)
+            top_bound = os.environ.get('QC_TOP_BOUND', '9')
+        if top_bound == 'auto':
+            top_bound = AdaptiveTopBound()
+        elif not isinstance(top_bound, AdaptiveTopBound):
+            top_bound = int(top_bound)
+        if skip_locked is None and os.environ.get('QC_SKIP_LOCKED'):
+            skip_locked = os.environ['QC_SKIP_LOCKED'] not in ('0', 'false')
         self.name, self.top_bound = name, top_bound
+        self._skip_locked = skip_locked
+        self._metrics = metrics
+        self.serializer = serializer or get_default_serializer()
+        if payload_threshold is None:
+            payload_threshold = int(
+                os.environ.get('QC_PAYLOAD_THRESHOLD', '0'))
+        self.payload_threshold = payload_threshold
+        self.payload_store = payload_store or get_default_payload_store()
+
+    @property
+    def metrics(self):
+        if self._metrics is None:
+            return get_default_metrics()
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self._metrics = metrics
+
+    @property
+    def skip_locked(self):
+        if self._skip_locked is None:
+            self._skip_locked = self.conn_adapter.server_version >= 90500
+        return self._skip_locked
+
+    @skip_locked.setter
+    def skip_locked(self, skip_locked):
+        self._skip_locked = skip_locked
+
+    # table:: Quoted name of the table holding the jobs of the queue: the
+    #         dedicated table of the queue if it has one (see
+    #         pueuey.setup.dedicate), else the shared queue_classic_jobs.
+    @property
+    def table(self):
+        if not hasattr(self, '_table'):
+            with self.conn_adapter.cursor(LoggingCursor) as curs:
+                self.__lookup_table(curs)
+        return self._table
+
+    # Looks the table of the queue up with curs, which may be a cursor of
+    # the application's connection (see Queue#enqueue): the queries can not
+    # fail, so its transaction is never aborted.
+    def __lookup_table(self, curs):
+        if not hasattr(self, '_table'):
+            table = '"queue_classic_jobs"'
+            curs.execute("SELECT 1 FROM pg_class "
+                         "WHERE relname = 'queue_classic_tables' "
+                         "AND pg_table_is_visible(oid)")
+            # absent when created before queue_classic_tables existed
+            if curs.fetchone() is not None:
+                curs.execute('SELECT quote_ident(table_name) '
+                             'FROM queue_classic_tables '
+                             'WHERE q_name = %s', [self.name])
+                row = curs.fetchone()
+                if row is not None:
+                    table = row[0]
+            self._table = table
+        return self._table
+
+    @table.setter
+    def table(self, table):
+        self._table = table
 
     @property
     def conn_adapter(self):
         if not hasattr(self, '_adapter'):
-            self._adapter = ConnAdapter()
+            self._adapter = PooledConnAdapter.shared()
         return self._adapter
 
     @conn_adapter.setter
@@ -52,62 +293,408 @@ class Queue(object):
     # `MyObject.new.puts`.
     # The args argument will be encoded as JSON and stored as a JSON datatype
     # in the row. (If the version of PG does not support JSON,
-    # then the args will be stored as text.
+    # then the args will be stored as text. Binary serializers store them
+    # in the data column instead, see pueuey.serializers.
     # The args are stored as a collection and then splatted inside the worker.
     # Examples of args include: `'hello world'`, `['hello world']`,
     # `'hello', 'world'`.
-    def enqueue(self, method, args):
+    # The connection argument is an optional psycopg2 connection or cursor
+    # of the application: the job is then inserted in its current
+    # transaction, without changing its isolation level, so it is only
+    # enqueued (and notified) if the application commits.
+    # The priority argument orders the jobs of the queue: jobs with a lower
+    # priority are locked first (the default priority is 0).
+    # The run_at argument delays the job: it is not locked before run_at,
+    # which is a datetime, a timedelta or a number of seconds from now.
+    # Args larger than payload_threshold are stored in payload_store in the
+    # same transaction as the job. A FilePayloadStore does not take part in
+    # the transaction: the files of a transaction of the application which
+    # is rolled back are left behind, see FilePayloadStore#sweep.
+    def enqueue(self, method, args, connection=None, priority=None,
+                run_at=None):
         with log_yield(measure='queue.enqueue'):
-            args = json.dumps(args)
-            with self.conn_adapter.connection\
-                    .cursor(cursor_factory=LoggingCursor) as curs:
-                curs.execute(
-                    'INSERT INTO "queue_classic_jobs" (q_name, method, args) '
-                    'VALUES (%s, %s, %s) RETURNING id',
-                    [self.name, method, args])
-                return curs.fetchone()[0]
+            with self.__cursor(connection, LoggingCursor) as curs:
+                sql = ('INSERT INTO ' + self.__lookup_table(curs) +
+                       ' (q_name, method, args, data, external, priority, '
+                       'run_at) VALUES (%s, %s, %s, %s, %s, %s, ' +
+                       _RUN_AT + ') RETURNING id')
+                columns, payload = self.__encode(args)
+                params = ([self.name, method] + columns +
+                          [priority or 0] + _run_at(run_at))
+                if payload is not None:
+                    with self.__transaction(curs, connection) as stored:
+                        curs.execute(sql, params)
+                        id = self.__inserted_id(curs)
+                        self.payload_store.put(curs, id, payload)
+                        stored.append(id)
+                elif connection is None:
+                    self.__execute(curs, 'qc_enqueue', sql, params)
+                    id = self.__inserted_id(curs)
+                else:
+                    curs.execute(sql, params)
+                    id = self.__inserted_id(curs)
+            self.metrics.increment('qc.enqueue', source=self.name)
+            return id
+
+    # enqueue_many(m,a) inserts one job per item of args_iter, all of them
+    # calling the same method with the same priority and run_at.
+    # See Queue#enqueue_batch.
+    def enqueue_many(self, method, args_iter, chunk_size=None,
+                     connection=None, priority=None, run_at=None):
+        return self.enqueue_batch(
+            ((method, args, priority, run_at) for args in args_iter),
+            chunk_size, connection)
+
+    # enqueue_batch(jobs) inserts many jobs in as few round trips as possible.
+    # jobs is an iterable (it can be a generator) of (method, args) or
+    # (method, args, priority, run_at) tuples, see Queue#enqueue.
+    # Rows are sent by chunks of chunk_size using a multi-row INSERT and the
+    # whole batch is wrapped in a single transaction: PostgreSQL folds the
+    # identical notifications sent by the trigger, so listeners receive one
+    # NOTIFY per queue for the whole batch instead of one per row.
+    # Returns the ids of the jobs in the order they were given.
+    # When a connection (or cursor) is given, the jobs are inserted in its
+    # current transaction instead, see Queue#enqueue.
+    def enqueue_batch(self, jobs, chunk_size=None, connection=None):
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        with log_yield(measure='queue.enqueue_batch'):
+            with self.__cursor(connection, LoggingCursor) as curs:
+                with self.__transaction(curs, connection) as stored:
+                    ids = self.__insert_chunks(curs, jobs, chunk_size,
+                                               stored)
+            self.metrics.increment('qc.enqueue', len(ids), source=self.name)
+            return ids
+
+    # Returns the id of the job just inserted with RETURNING id. No row is
+    # returned when the queue was dedicated since its table was looked up:
+    # the job was routed to the dedicated table by queue_classic_route, and
+    # its id is the last one taken from the sequence by the session.
+    def __inserted_id(self, curs):
+        row = curs.fetchone()
+        if row is not None:
+            return row[0]
+        del self._table
+        curs.execute("SELECT currval(pg_get_serial_sequence("
+                     "'queue_classic_jobs', 'id'))")
+        return curs.fetchone()[0]
+
+    # Yields a cursor on the connection of the adapter or, if given, on the
+    # application's connection (or the connection of its cursor).
+    @contextmanager
+    def __cursor(self, connection, cursor_factory):
+        if connection is None:
+            with self.conn_adapter.cursor(cursor_factory) as curs:
+                yield curs
+        else:
+            connection = getattr(connection, 'connection', connection)
+            with connection.cursor(cursor_factory=cursor_factory) as curs:
+                yield curs
+
+    # Wraps the statements executed on curs in a transaction, unless they are
+    # executed in a transaction of the application (an application's
+    # connection in autocommit mode gets one of its own). Yields the list of
+    # the ids whose payloads were stored: as payload_store may not take part
+    # in the transaction (see FilePayloadStore), they are deleted from it if
+    # the transaction is rolled back.
+    @contextmanager
+    def __transaction(self, curs, connection):
+        stored = []
+        if connection is not None and not (
+                curs.connection.autocommit and
+                curs.connection.get_transaction_status() ==
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+            yield stored
+            return
+        curs.execute('BEGIN')
+        try:
+            yield stored
+        except:
+            curs.execute('ROLLBACK')
+            if stored:
+                try:
+                    self.payload_store.delete(curs, stored)
+                except Exception, e:
+                    log(at='payload_cleanup', error=repr(e))
+            raise
+        else:
+            curs.execute('COMMIT')
+
+    def __insert_chunks(self, curs, jobs, chunk_size, stored):
+        ids = []
+        jobs = iter(jobs)
+        while True:
+            chunk = list(itertools.islice(jobs, chunk_size))
+            if not chunk:
+                return ids
+            ids.extend(self.__insert_chunk(curs, chunk, stored))
+
+    # The ids are taken from the sequence beforehand: RETURNING would not
+    # return the jobs routed to a dedicated table by queue_classic_route
+    # (see Queue#enqueue).
+    def __insert_chunk(self, curs, chunk, stored):
+        curs.execute("SELECT nextval(pg_get_serial_sequence("
+                     "'queue_classic_jobs', 'id')) "
+                     "FROM generate_series(1, %s)", [len(chunk)])
+        ids = [row[0] for row in curs.fetchall()]
+        values, payloads = [], []
+        for id, job in zip(ids, chunk):
+            method, args, priority, run_at = (tuple(job) + (None, None))[:4]
+            columns, payload = self.__encode(args)
+            values.append(curs.mogrify(
+                '(%s, %s, %s, %s, %s, %s, %s, ' + _RUN_AT + ')',
+                [id, self.name, method] + columns +
+                [priority or 0] + _run_at(run_at)))
+            payloads.append(payload)
+        curs.execute(
+            'INSERT INTO ' + self.__lookup_table(curs) +
+            ' (id, q_name, method, args, data, external, priority, run_at) '
+            'VALUES ' + ','.join(values))
+        for id, payload in zip(ids, payloads):
+            if payload is not None:
+                self.payload_store.put(curs, id, payload)
+                stored.append(id)
+        return ids
+
+    # Returns the values of the args, data and external columns of a job,
+    # and its encoded args if they must be stored in payload_store (None
+    # otherwise).
+    def __encode(self, args):
+        payload = self.serializer.dumps(args)
+        if 0 < self.payload_threshold <= len(payload):
+            return ['null', None, True], payload
+        if self.serializer.binary:
+            return ['null', psycopg2.Binary(payload), False], None
+        return [payload, None, False], None
 
-    def lock(self, top_bound=None):
+    # Returns the Job of a row of _LOCK_COLUMNS, after recording its time to
+    # lock. The payloads stored out of line are fetched only now that the
+    # job is locked.
+    def __job(self, row):
+        id, q_name, method, args, data, external, created_at, waited = row
+        if waited is not None:
+            self.metrics.timing('qc.time-to-lock', waited, source=self.name)
+        if external:
+            with self.conn_adapter.cursor(LoggingCursor) as curs:
+                payload = self.payload_store.get(curs, id)
+            if self.serializer.binary:
+                payload = buffer(payload)
+            args = self.serializer.loads(payload)
+        elif self.serializer.binary:
+            args = self.serializer.loads(data)
+        else:
+            args = self.serializer.loads(args)
+        return Job(id, q_name, method, args, created_at)
+
+    # lock() claims the head of the queue. top_bound is only used by the
+    # lock_head fallback, see skip_locked. The latency of the locks of a
+    # queue with an AdaptiveTopBound is given to the bound, whose value is
+    # recorded as the qc.top-bound gauge.
+    def lock(self, top_bound=None, skip_locked=None):
         with log_yield(measure='queue.lock'):
             if top_bound is None:
                 top_bound = self.top_bound
-            with self.conn_adapter.connection\
-                    .cursor(cursor_factory=LoggingRealDictCursor) as curs:
-                curs.execute(
-                    "SELECT * FROM lock_head(%s, %s)", [self.name, top_bound])
-                if not curs.rowcount:
-                    return None
-                job = curs.fetchone()
-            # NOTE: JSON in args is parsed automatically
-            #       timestamptz columns are converted automatically to datetime
-            if job['created_at']:
-                now = datetime.datetime.now(job['created_at'].tzinfo)
-                ttl = now - job['created_at']
-                _logger.info("measure#qc.time-to-lock=%sms source=%s"
-                             % (int(ttl.microseconds / 1000), self.name))
-            return job
+            if skip_locked is None:
+                skip_locked = self.skip_locked
+            start = monotonic()
+            with self.conn_adapter.cursor(LoggingJobCursor,
+                                          reuse=True) as curs:
+                if skip_locked:
+                    self.__execute(curs, 'qc_lock_skip_locked',
+                        "SELECT " + _LOCK_COLUMNS +
+                        " FROM lock_head_skip_locked(%s)", [self.name])
+                else:
+                    self.__execute(curs, 'qc_lock',
+                        "SELECT " + _LOCK_COLUMNS +
+                        " FROM lock_head(%s, %s)",
+                        [self.name, int(top_bound)])
+                row = curs.fetchone()
+            if row is None:
+                return None
+            if (not skip_locked and isinstance(top_bound, AdaptiveTopBound)
+                    and top_bound.observe(monotonic() - start)):
+                self.metrics.gauge('qc.top-bound', int(top_bound),
+                                   source=self.name)
+            self.metrics.increment('qc.lock', source=self.name)
+            return self.__job(row)
+
+    # lock_many(n) claims up to n jobs at once and returns them as a list
+    # ordered by id (an empty list if there is no job available).
+    # Without SKIP LOCKED support it falls back on calling lock() n times.
+    def lock_many(self, n, top_bound=None, skip_locked=None):
+        if skip_locked is None:
+            skip_locked = self.skip_locked
+        if not skip_locked:
+            jobs = []
+            for i in range(n):
+                job = self.lock(top_bound, skip_locked=False)
+                if job is None:
+                    break
+                jobs.append(job)
+            return jobs
+        with log_yield(measure='queue.lock_many'):
+            with self.conn_adapter.cursor(LoggingJobCursor,
+                                          reuse=True) as curs:
+                self.__execute(curs, 'qc_lock_many',
+                    "SELECT " + _LOCK_COLUMNS +
+                    " FROM lock_head_many(%s, %s)", [self.name, n])
+                rows = curs.fetchall()
+            if rows:
+                self.metrics.increment('qc.lock', len(rows), source=self.name)
+            rows.sort()
+            return [self.__job(row) for row in rows]
+
+    # lock_first(queues, n) claims up to n jobs in the first of queues which
+    # has available jobs and returns them as a list of (queue, job) ordered
+    # by id. The queues are tried left to right in a single call to
+    # lock_head_multi. They must share the same connection adapter.
+    # Without SKIP LOCKED support it falls back on trying each queue in turn.
+    @staticmethod
+    def lock_first(queues, n=1):
+        if not queues:
+            return []
+        first = queues[0]
+        if len(queues) == 1 or not first.skip_locked:
+            for queue in queues:
+                jobs = queue.lock_many(n) if n > 1 else [queue.lock()]
+                jobs = [(queue, job) for job in jobs if job]
+                if jobs:
+                    return jobs
+            return []
+        names = [queue.name for queue in queues]
+        by_name = dict((queue.name, queue) for queue in reversed(queues))
+        with log_yield(measure='queue.lock_first'):
+            with first.conn_adapter.cursor(LoggingJobCursor,
+                                           reuse=True) as curs:
+                first.__execute(curs, 'qc_lock_first',
+                    "SELECT " + _LOCK_COLUMNS +
+                    " FROM lock_head_multi(%s::varchar[], %s)", [names, n])
+                rows = curs.fetchall()
+        if not rows:
+            return []
+        rows.sort()
+        queue = by_name[rows[0][1]]
+        queue.metrics.increment('qc.lock', len(rows), source=queue.name)
+        return [(queue, queue.__job(row)) for row in rows]
+
+    # due_in(queues) returns the number of seconds until the next job of
+    # queues scheduled in the future is due, 0 if a job is already due and
+    # None if the queues have no unlocked job. The queues must share the
+    # same connection adapter.
+    @staticmethod
+    def due_in(queues):
+        if not queues:
+            return None
+        first = queues[0]
+        with log_yield(measure='queue.due_in'):
+            with first.conn_adapter.cursor(LoggingCursor) as curs:
+                first.__execute(curs, 'qc_due_in',
+                    "SELECT extract(epoch FROM "
+                    "queue_classic_next_run_at(%s::varchar[]) - now())",
+                    [[queue.name for queue in queues]])
+                due_in = curs.fetchone()[0]
+        if due_in is None:
+            return None
+        return max(float(due_in), 0.0)
 
     def unlock(self, id):
         with log_yield(measure='queue.unlock'):
-            return self.conn_adapter.execute(
-                'UPDATE "queue_classic_jobs" '
-                'SET locked_at = NULL WHERE id = %s', [id])
+            with self.conn_adapter.cursor(LoggingCursor) as curs:
+                self.__execute(curs, 'qc_unlock',
+                    'UPDATE ' + self.__lookup_table(curs) +
+                    ' SET locked_at = NULL, locked_by = NULL WHERE id = %s',
+                    [id])
+
+    def unlock_many(self, ids):
+        with log_yield(measure='queue.unlock_many'):
+            with self.conn_adapter.cursor(LoggingCursor) as curs:
+                self.__execute(curs, 'qc_unlock_many',
+                    'UPDATE ' + self.__lookup_table(curs) +
+                    ' SET locked_at = NULL, locked_by = NULL '
+                    'WHERE id = ANY(%s)', [list(ids)])
 
+    # The deletions return the ids of the deleted jobs whose payload is
+    # stored out of line, which are then deleted from payload_store.
     def delete(self, id):
         with log_yield(measure='queue.delete'):
-            return self.conn_adapter.execute(
-                'DELETE FROM "queue_classic_jobs" WHERE id = %s', [id])
+            self.__delete('qc_delete', 'id = %s', [id])
+
+    def delete_many(self, ids):
+        with log_yield(measure='queue.delete_many'):
+            self.__delete('qc_delete_many', 'id = ANY(%s)', [list(ids)])
+
+    # fail_many(ids, errors) records in a single statement the failures of
+    # jobs, errors giving the error (a string) of each job: the jobs which
+    # were attempted max_attempts times are moved to the dead-letter table
+    # queue_classic_failed_jobs, the others are unlocked and retried after
+    # an exponential backoff (backoff seconds, doubled after each attempt,
+    # up to max_backoff seconds). Returns the number of dead jobs.
+    def fail_many(self, ids, errors, max_attempts=1, backoff=10,
+                  max_backoff=3600):
+        with log_yield(measure='queue.fail_many'):
+            with self.conn_adapter.cursor(LoggingCursor) as curs:
+                self.__execute(curs, 'qc_fail_many',
+                    'SELECT queue_classic_fail(%s::bigint[], %s::text[], '
+                    '%s, %s, %s)',
+                    [list(ids), list(errors), max_attempts, backoff,
+                     max_backoff])
+                return curs.fetchone()[0]
 
     def delete_all(self):
         with log_yield(measure='queue.delete_all'):
-            return self.conn_adapter.execute(
-                'DELETE FROM "queue_classic_jobs" WHERE q_name = %s',
-                [self.name])
+            self.__delete(None, 'q_name = %s', [self.name],
+                          '"queue_classic_jobs"')
+
+    def __delete(self, name, where, args, table=None):
+        with self.conn_adapter.cursor(LoggingCursor) as curs:
+            sql = ('WITH deleted AS (DELETE FROM ' +
+                   (table or self.__lookup_table(curs)) +
+                   ' WHERE ' + where + ' RETURNING id, external) '
+                   'SELECT id FROM deleted WHERE external')
+            if name is None:
+                curs.execute(sql, args)
+            else:
+                self.__execute(curs, name, sql, args)
+            ids = [row[0] for row in curs.fetchall()]
+            if ids:
+                self.payload_store.delete(curs, ids)
 
     def count(self):
         with log_yield(measure='queue.count'):
-            with self.conn_adapter.connection\
-                    .cursor(cursor_factory=psycopg2.extensions.cursor) as curs:
-                curs.execute('SELECT COUNT(*) FROM "queue_classic_jobs" '
-                             'WHERE q_name = %s', [self.name])
+            with self.conn_adapter.cursor(LoggingCursor) as curs:
+                self.__execute(curs, 'qc_count',
+                    'SELECT COUNT(*) FROM ONLY ' + self.__lookup_table(curs) +
+                    ' WHERE q_name = %s', [self.name])
                 return curs.fetchone()[0]
+
+    # stats() returns the numbers of ready (unlocked and due), locked and
+    # total jobs of the queue as a dict, or a dict of these dicts by queue
+    # name for every queue when all_queues is true. Unlike Queue#count, it
+    # is cheap enough to be polled often: the ready and total jobs are
+    # estimated by the planner (see queue_classic_stats) unless exact is
+    # true, the estimates are never lower than 1.
+    def stats(self, exact=False, all_queues=False):
+        with log_yield(measure='queue.stats'):
+            with self.conn_adapter.cursor(LoggingRealDictCursor) as curs:
+                curs.execute(
+                    'SELECT * FROM queue_classic_stats(%s::varchar[], %s)',
+                    [None if all_queues else [self.name], exact])
+                stats = dict((row.pop('q_name'), dict(row))
+                             for row in curs.fetchall())
+        if all_queues:
+            return stats
+        return stats[self.name]
+
+    # Executes a hot statement, as a prepared statement if the adapter
+    # prepares statements (see ConnAdapter).
+    # Statements on a dedicated table are prepared under a name of their own.
+    # The table is looked up on curs: checking out another connection of a
+    # PooledConnAdapter while curs holds one could exhaust the pool.
+    def __execute(self, curs, name, sql, args):
+        table = self.__lookup_table(curs)
+        if table != '"queue_classic_jobs"':
+            name += '_' + hashlib.md5(table).hexdigest()[:8]
+        if self.conn_adapter.prepare:
+            curs.execute_prepared(name, sql, args)
+        else:
+            curs.execute(sql, args)
@@ -0,0 +1,88 @@
+import os
+import threading
+import psycopg2.extensions
+
+from log import log, log_yield
+from conn_adapter import ConnAdapter
+from metrics import get_default as get_default_metrics
+
+__all__ = ['Reaper']
+
+
+# A Reaper unlocks the jobs which would otherwise stay locked forever: the
+# jobs of the dead workers (see queue_classic_reap) and the jobs locked for
+# longer than the lock timeout of their queue, whoever locked them (see
+# queue_classic_unlock_expired and queue_classic_unlock_expired_others).
+# The lock timeouts recover the jobs of the clients which are not
+# registered workers, see queue_classic_reap. It can run in a process of
+# its own with Reaper#start, or in the heartbeat thread of a worker (see
+# the reap_interval option of Worker).
+class Reaper(object):
+
+    # connection:: PGConn object.
+    # stale:: Age (in seconds) of its last heartbeat after which a worker is
+    #         considered dead. It should be a few heartbeat intervals.
+    # timeouts:: Lock timeouts (in seconds) by queue name, read from
+    #            QC_LOCK_TIMEOUTS (name=seconds,...) by default.
+    # timeout:: Lock timeout (in seconds) of the other queues, read from
+    #           QC_LOCK_TIMEOUT (3600 by default). 0 disables it. It must
+    #           be longer than the longest job.
+    # interval:: Time between two reaps of Reaper#start.
+    # metrics:: Metrics sink, by default the one given by
+    #           pueuey.metrics.get_default().
+    def __init__(self, connection=None, stale=None, timeouts=None,
+                 interval=None, metrics=None, timeout=None):
+        if stale is None:
+            stale = float(os.environ.get('QC_STALE_TIMEOUT', '60'))
+        if timeouts is None:
+            timeouts = dict(
+                (name, float(seconds)) for name, seconds in
+                (item.split('=') for item in
+                 os.environ.get('QC_LOCK_TIMEOUTS', '').split(',') if item))
+        if timeout is None:
+            timeout = float(os.environ.get('QC_LOCK_TIMEOUT', '3600'))
+        if interval is None:
+            interval = float(os.environ.get('QC_REAP_INTERVAL', '30'))
+        self.stale = stale
+        self.timeouts = timeouts
+        self.timeout = timeout
+        self.interval = interval
+        self.metrics = metrics or get_default_metrics()
+        self.conn_adapter = ConnAdapter(connection)
+        self.stopped = threading.Event()
+
+    # Unlocks the jobs of the dead workers and the expired jobs.
+    # Returns the number of unlocked jobs.
+    def reap(self):
+        with log_yield(measure='reaper.reap'):
+            reaped = {}
+            cursor_factory = psycopg2.extensions.cursor
+            with self.conn_adapter.cursor(cursor_factory) as curs:
+                curs.execute("SELECT queue_classic_reap(%s * interval '1s')",
+                             [self.stale])
+                reaped[None] = curs.fetchone()[0]
+                for name, timeout in sorted(self.timeouts.items()):
+                    curs.execute("SELECT queue_classic_unlock_expired(%s, "
+                                 "%s * interval '1s')", [name, timeout])
+                    reaped[name] = curs.fetchone()[0]
+                if self.timeout > 0:
+                    curs.execute("SELECT queue_classic_unlock_expired_others("
+                                 "%s * interval '1s', %s::varchar[])",
+                                 [self.timeout, sorted(self.timeouts)])
+                    reaped[None] += curs.fetchone()[0]
+            for name, count in reaped.items():
+                if count:
+                    log(at="reap", queue=name, count=count)
+                    tags = {} if name is None else {'source': name}
+                    self.metrics.increment('qc.reaped', count, **tags)
+            return sum(reaped.values())
+
+    # Reaps every interval seconds until Reaper#stop is called.
+    def start(self):
+        while True:
+            self.reap()
+            if self.stopped.wait(self.interval):
+                break
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,100 @@
+import os
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ['Serializer', 'JsonSerializer', 'MsgpackSerializer', 'Raw',
+           'get', 'get_default']
+
+
+# A Serializer encodes the args of the jobs when they are enqueued and
+# decodes them when they are locked (see Queue). Its subclasses implement:
+# dumps(args):: Returns the args encoded as a str.
+# loads(data):: Returns the args decoded from data (a str, or a buffer for
+#               binary serializers).
+# Textual serializers store the args in the args column (json), binary
+# serializers in the data column (bytea). The producers and the workers of
+# a queue must use the same serializer.
+# raw:: The args are given undecoded to the jobs, see Raw.
+class Serializer(object):
+    binary = False
+    raw = False
+
+
+# Encodes the args in JSON with the json module, or with module (such as
+# ujson, several times faster on large payloads, see get). The jobs stay
+# readable by queue_classic.
+class JsonSerializer(Serializer):
+    def __init__(self, module=None):
+        self.module = module or json
+
+    def dumps(self, args):
+        return self.module.dumps(args)
+
+    def loads(self, data):
+        return self.module.loads(data)
+
+
+# Encodes the args with MessagePack into the data column: smaller payloads
+# which are faster to encode and decode than JSON, but which can not be
+# queried nor read by queue_classic. Requires the msgpack package.
+class MsgpackSerializer(Serializer):
+    binary = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("msgpack is required by MsgpackSerializer")
+
+    def dumps(self, args):
+        return msgpack.packb(args, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# Encodes the args with serializer but does not decode them: each job
+# gets the raw payload (the JSON string or the buffer of the data column)
+# as its only argument, and can decode it lazily, partially or not at all.
+class Raw(Serializer):
+    raw = True
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+        self.binary = serializer.binary
+
+    def dumps(self, args):
+        return self.serializer.dumps(args)
+
+    def loads(self, data):
+        return data
+
+
+# Returns a serializer by name: json, ujson, msgpack, or one of them
+# prefixed by raw: (raw:json, raw:msgpack...), see Raw.
+# ujson is JSON encoded with ujson: the releases supporting Python 2 round
+# the floats to their double_precision, so the floats of the args do not
+# round-trip exactly.
+def get(name):
+    if name.startswith('raw:'):
+        return Raw(get(name[len('raw:'):]))
+    if name == 'json':
+        return JsonSerializer()
+    if name == 'ujson':
+        if ujson is None:
+            raise ImportError("ujson is required by the ujson serializer")
+        return JsonSerializer(ujson)
+    if name == 'msgpack':
+        return MsgpackSerializer()
+    raise ValueError("unknown serializer %r" % name)
+
+# Returns the serializer named by QC_SERIALIZER (json by default).
+def get_default():
+    return get(os.environ.get('QC_SERIALIZER', 'json'))
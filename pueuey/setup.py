@@ -1,4 +1,5 @@
 import os
+import psycopg2.extensions
 
 from conn_adapter import ConnAdapter
 
@@ -8,13 +9,30 @@ SqlFunctions = os.path.join(Root, 'sql', 'ddl.sql')
 CreateTable = os.path.join(Root, 'sql', 'create_table.sql')
 DropSqlFunctions = os.path.join(Root, 'sql', 'drop_ddl.sql')
 
-def create(connection=None):
+# queues:: Names of the queues to give a dedicated table, see dedicate.
+def create(connection=None, queues=()):
     conn_adapter = ConnAdapter(connection)
     conn_adapter.execute(open(CreateTable).read())
     conn_adapter.execute(open(SqlFunctions).read())
+    for q_name in queues:
+        conn_adapter.execute('SELECT queue_classic_dedicate(%s)', [q_name])
     if connection is None:
         conn_adapter.disconnect()
 
+# Moves the jobs of a queue into a table of their own, which inherits from
+# queue_classic_jobs. A busy queue then has its own index and is vacuumed on
+# its own: the dead rows left by the other queues do not slow down its
+# locks. The jobs remain visible from queue_classic_jobs.
+# Workers started before the queue was dedicated should be restarted.
+def dedicate(q_name, connection=None):
+    conn_adapter = ConnAdapter(connection)
+    with conn_adapter.cursor(psycopg2.extensions.cursor) as curs:
+        curs.execute('SELECT queue_classic_dedicate(%s)', [q_name])
+        table = curs.fetchone()[0]
+    if connection is None:
+        conn_adapter.disconnect()
+    return table
+
 def drop(connection=None):
     conn_adapter = ConnAdapter(connection)
     conn_adapter.execute(open(DropSqlFunctions).read())
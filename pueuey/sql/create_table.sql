@@ -6,7 +6,14 @@ CREATE TABLE queue_classic_jobs (
   method text not null check (length(method) > 0),
   args   text not null,
   locked_at timestamptz,
-  created_at timestamptz default now()
+  created_at timestamptz default now(),
+  priority integer not null default 0,
+  run_at timestamptz not null default now(),
+  locked_by integer,
+  attempts integer not null default 0,
+  last_error text,
+  data bytea,
+  external boolean not null default false
 );
 
 -- If json type is available, use it for the args column.
@@ -27,4 +34,5 @@ after insert on queue_classic_jobs
 for each row
 execute procedure queue_classic_notify();
 
-CREATE INDEX idx_qc_on_name_only_unlocked ON queue_classic_jobs (q_name, id) WHERE locked_at IS NULL;
+CREATE INDEX idx_qc_on_name_priority_run_at_unlocked ON queue_classic_jobs (q_name, priority, run_at, id) WHERE locked_at IS NULL;
+CREATE INDEX idx_qc_on_name_locked_at ON queue_classic_jobs (q_name, locked_at) WHERE locked_at IS NOT NULL;
@@ -3,25 +3,254 @@
 -- have identical columns to queue_classic_jobs.
 -- When QC supports queues with columns other than the default, we will have to change this.
 
+-- Adds the columns introduced after the creation of queue_classic_jobs to
+-- the tables created by older versions.
+
+DO $$ BEGIN
+  PERFORM 1 FROM pg_attribute
+  WHERE attrelid = 'queue_classic_jobs'::regclass
+  AND attname = 'run_at' AND NOT attisdropped;
+  IF NOT FOUND THEN
+    ALTER TABLE queue_classic_jobs
+      ADD COLUMN priority integer NOT NULL DEFAULT 0,
+      ADD COLUMN run_at timestamptz NOT NULL DEFAULT now();
+    DROP INDEX IF EXISTS idx_qc_on_name_only_unlocked;
+    CREATE INDEX idx_qc_on_name_priority_run_at_unlocked
+      ON queue_classic_jobs (q_name, priority, run_at, id)
+      WHERE locked_at IS NULL;
+  END IF;
+
+  PERFORM 1 FROM pg_attribute
+  WHERE attrelid = 'queue_classic_jobs'::regclass
+  AND attname = 'locked_by' AND NOT attisdropped;
+  IF NOT FOUND THEN
+    ALTER TABLE queue_classic_jobs ADD COLUMN locked_by integer;
+    CREATE INDEX idx_qc_on_name_locked_at
+      ON queue_classic_jobs (q_name, locked_at)
+      WHERE locked_at IS NOT NULL;
+  END IF;
+
+  PERFORM 1 FROM pg_attribute
+  WHERE attrelid = 'queue_classic_jobs'::regclass
+  AND attname = 'attempts' AND NOT attisdropped;
+  IF NOT FOUND THEN
+    ALTER TABLE queue_classic_jobs
+      ADD COLUMN attempts integer NOT NULL DEFAULT 0,
+      ADD COLUMN last_error text;
+  END IF;
+
+  PERFORM 1 FROM pg_attribute
+  WHERE attrelid = 'queue_classic_jobs'::regclass
+  AND attname = 'data' AND NOT attisdropped;
+  IF NOT FOUND THEN
+    ALTER TABLE queue_classic_jobs ADD COLUMN data bytea;
+  END IF;
+
+  PERFORM 1 FROM pg_attribute
+  WHERE attrelid = 'queue_classic_jobs'::regclass
+  AND attname = 'external' AND NOT attisdropped;
+  IF NOT FOUND THEN
+    ALTER TABLE queue_classic_jobs
+      ADD COLUMN external boolean NOT NULL DEFAULT false;
+  END IF;
+END $$;
+
+-- Jobs which failed too many times are moved to queue_classic_failed_jobs
+-- (see queue_classic_fail) with the error of their last attempt.
+
+CREATE TABLE IF NOT EXISTS queue_classic_failed_jobs (
+  LIKE queue_classic_jobs,
+  failed_at timestamptz NOT NULL DEFAULT now(),
+  PRIMARY KEY (id)
+);
+
+DO $$ BEGIN
+  PERFORM 1 FROM pg_attribute
+  WHERE attrelid = 'queue_classic_failed_jobs'::regclass
+  AND attname = 'data' AND NOT attisdropped;
+  IF NOT FOUND THEN
+    ALTER TABLE queue_classic_failed_jobs ADD COLUMN data bytea;
+  END IF;
+
+  PERFORM 1 FROM pg_attribute
+  WHERE attrelid = 'queue_classic_failed_jobs'::regclass
+  AND attname = 'external' AND NOT attisdropped;
+  IF NOT FOUND THEN
+    ALTER TABLE queue_classic_failed_jobs
+      ADD COLUMN external boolean NOT NULL DEFAULT false;
+  END IF;
+END $$;
+
+-- The payloads of the jobs whose external column is true are stored out of
+-- line under the id of their job, by default in queue_classic_payloads (see
+-- pueuey.payloads). They are kept when the job is moved to
+-- queue_classic_failed_jobs.
+
+CREATE TABLE IF NOT EXISTS queue_classic_payloads (
+  job_id bigint PRIMARY KEY,
+  data bytea NOT NULL
+);
+
+-- Workers register in queue_classic_workers under the backend pid of the
+-- connection they lock jobs with, which lock_head and friends store in the
+-- locked_by column of the jobs, and update heartbeat_at periodically.
+-- See queue_classic_reap.
+
+CREATE TABLE IF NOT EXISTS queue_classic_workers (
+  pid integer PRIMARY KEY,
+  q_names text[] NOT NULL,
+  host text,
+  os_pid integer,
+  started_at timestamptz NOT NULL DEFAULT now(),
+  heartbeat_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- Queues can have a dedicated table (see queue_classic_dedicate) which
+-- inherits from queue_classic_jobs: its rows are still visible from
+-- queue_classic_jobs but it is vacuumed and indexed on its own.
+-- queue_classic_tables maps the names of these queues to their table.
+
+CREATE TABLE IF NOT EXISTS queue_classic_tables (
+  q_name text PRIMARY KEY,
+  table_name text NOT NULL UNIQUE
+);
+
+-- Returns the relation holding the jobs of a queue, ready to be used in a
+-- dynamic query: its dedicated table or only the shared table.
+
+CREATE OR REPLACE FUNCTION queue_classic_relation(q_name varchar)
+RETURNS text AS $$
+  SELECT coalesce(
+    (SELECT quote_ident(t.table_name) FROM queue_classic_tables t
+     WHERE t.q_name = $1),
+    'ONLY queue_classic_jobs');
+$$ LANGUAGE sql STABLE;
+
+-- Routes the jobs inserted into queue_classic_jobs for a queue which has a
+-- dedicated table into that table, for the clients which do not know about
+-- it (queue_classic, older clients, Queue objects which looked the table up
+-- before the queue was dedicated). The trigger is created by the first
+-- call to queue_classic_dedicate. The rows are not inserted into
+-- queue_classic_jobs, so INSERT ... RETURNING returns no row for them.
+
+CREATE OR REPLACE FUNCTION queue_classic_route() RETURNS trigger AS $$
+DECLARE
+  tname text;
+BEGIN
+  SELECT t.table_name INTO tname FROM queue_classic_tables t
+  WHERE t.q_name = NEW.q_name;
+  IF NOT FOUND THEN
+    RETURN NEW;
+  END IF;
+  EXECUTE 'INSERT INTO ' || quote_ident(tname) || ' SELECT ($1).*'
+  USING NEW;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Creates the dedicated table of a queue, with its own index and trigger,
+-- and moves the jobs of the queue into it. Returns the name of the table.
+-- The inserts into queue_classic_jobs are blocked until the transaction
+-- commits, so that no job is left behind.
+
+CREATE OR REPLACE FUNCTION queue_classic_dedicate(q_name varchar)
+RETURNS text AS $$
+DECLARE
+  tname text;
+BEGIN
+  SELECT t.table_name INTO tname FROM queue_classic_tables t
+  WHERE t.q_name = queue_classic_dedicate.q_name;
+  IF FOUND THEN
+    RETURN tname;
+  END IF;
+
+  PERFORM 1 FROM pg_trigger
+  WHERE tgrelid = 'queue_classic_jobs'::regclass
+  AND tgname = 'queue_classic_route';
+  IF NOT FOUND THEN
+    CREATE TRIGGER queue_classic_route
+    BEFORE INSERT ON queue_classic_jobs
+    FOR EACH ROW
+    EXECUTE PROCEDURE queue_classic_route();
+  END IF;
+  LOCK TABLE ONLY queue_classic_jobs IN SHARE ROW EXCLUSIVE MODE;
+
+  tname := 'queue_classic_jobs_' || q_name;
+  IF length(tname) > 63 THEN
+    tname := 'queue_classic_jobs_' || md5(q_name);
+  END IF;
+
+  EXECUTE 'CREATE TABLE ' || quote_ident(tname) || ' ('
+    || ' PRIMARY KEY (id),'
+    || ' CHECK (q_name = ' || quote_literal(q_name) || ')'
+    || ') INHERITS (queue_classic_jobs)';
+  EXECUTE 'CREATE INDEX ' || quote_ident('idx_' || tname || '_unlocked')
+    || ' ON ' || quote_ident(tname) || ' (priority, run_at, id)'
+    || ' WHERE locked_at IS NULL';
+  EXECUTE 'CREATE INDEX ' || quote_ident('idx_' || tname || '_locked_at')
+    || ' ON ' || quote_ident(tname) || ' (q_name, locked_at)'
+    || ' WHERE locked_at IS NOT NULL';
+  EXECUTE 'CREATE TRIGGER queue_classic_notify'
+    || ' AFTER INSERT ON ' || quote_ident(tname)
+    || ' FOR EACH ROW EXECUTE PROCEDURE queue_classic_notify()';
+  EXECUTE 'INSERT INTO ' || quote_ident(tname)
+    || ' SELECT * FROM ONLY queue_classic_jobs WHERE q_name = $1'
+  USING q_name;
+  DELETE FROM ONLY queue_classic_jobs j WHERE j.q_name = $1;
+  INSERT INTO queue_classic_tables VALUES (q_name, tname);
+  RETURN tname;
+END;
+$$ LANGUAGE plpgsql;
+
+-- queue_classic_head returns the ids of the n first due (run_at <= now())
+-- unlocked jobs of the queue, in the order they are locked: by priority,
+-- run_at and id. The distinct priorities are walked one index lookup at a
+-- time and each one is probed for its due jobs with a range scan on
+-- (priority, run_at), so the jobs scheduled in the future are never
+-- scanned however many they are.
+
+CREATE OR REPLACE FUNCTION queue_classic_head(q_name varchar, n integer)
+RETURNS SETOF bigint AS $$
+DECLARE
+  relation text := queue_classic_relation(q_name);
+  prio bigint := -2147483649;
+  job_id bigint;
+BEGIN
+  WHILE n > 0 LOOP
+    EXECUTE 'SELECT priority FROM ' || relation
+      || ' WHERE q_name = $1 AND locked_at IS NULL AND priority > $2'
+      || ' ORDER BY priority LIMIT 1'
+    INTO prio
+    USING q_name, prio;
+    EXIT WHEN prio IS NULL;
+    FOR job_id IN EXECUTE 'SELECT id FROM ' || relation
+      || ' WHERE q_name = $1 AND locked_at IS NULL AND priority = $2'
+      || ' AND run_at <= now()'
+      || ' ORDER BY run_at, id LIMIT $3'
+      USING q_name, prio, n
+    LOOP
+      RETURN NEXT job_id;
+      n := n - 1;
+    END LOOP;
+  END LOOP;
+
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
 CREATE OR REPLACE FUNCTION lock_head(q_name varchar, top_boundary integer)
 RETURNS SETOF queue_classic_jobs AS $$
 DECLARE
   unlocked bigint;
   relative_top integer;
   job_count integer;
+  relation text := queue_classic_relation(q_name);
 BEGIN
   -- The purpose is to release contention for the first spot in the table.
   -- The select count(*) is going to slow down dequeue performance but allow
   -- for more workers. Would love to see some optimization here...
 
-  EXECUTE 'SELECT count(*) FROM '
-    || '(SELECT * FROM queue_classic_jobs '
-    || ' WHERE locked_at IS NULL'
-    || ' AND q_name = '
-    || quote_literal(q_name)
-    || ' LIMIT '
-    || quote_literal(top_boundary)
-    || ') limited'
+  SELECT count(*) FROM queue_classic_head(q_name, top_boundary)
   INTO job_count;
 
   SELECT TRUNC(random() * (top_boundary - 1))
@@ -33,15 +262,13 @@ BEGIN
 
   LOOP
     BEGIN
-      EXECUTE 'SELECT id FROM queue_classic_jobs '
-        || ' WHERE locked_at IS NULL'
-        || ' AND q_name = '
-        || quote_literal(q_name)
-        || ' ORDER BY id ASC'
-        || ' LIMIT 1'
-        || ' OFFSET ' || quote_literal(relative_top)
+      EXECUTE 'SELECT id FROM ' || relation
+        || ' WHERE id = (SELECT h FROM queue_classic_head($1, $2) h'
+        || '             OFFSET $3 LIMIT 1)'
+        || ' AND locked_at IS NULL'
         || ' FOR UPDATE NOWAIT'
-      INTO unlocked;
+      INTO unlocked
+      USING q_name, relative_top + 1, relative_top;
       EXIT;
     EXCEPTION
       WHEN lock_not_available THEN
@@ -49,8 +276,8 @@ BEGIN
     END;
   END LOOP;
 
-  RETURN QUERY EXECUTE 'UPDATE queue_classic_jobs '
-    || ' SET locked_at = (CURRENT_TIMESTAMP)'
+  RETURN QUERY EXECUTE 'UPDATE ' || relation
+    || ' SET locked_at = (CURRENT_TIMESTAMP), locked_by = pg_backend_pid()'
     || ' WHERE id = $1'
     || ' AND locked_at is NULL'
     || ' RETURNING *'
@@ -66,3 +293,359 @@ BEGIN
   RETURN QUERY EXECUTE 'SELECT * FROM lock_head($1,10)' USING tname;
 END;
 $$ LANGUAGE plpgsql;
+
+-- lock_head_skip_locked claims the head of the queue with lock_head_many,
+-- which walks the distinct priorities with one dynamic statement each.
+-- Rows locked by other transactions are skipped instead of waited for, so
+-- there is no need for the count(*) and the random offset used by lock_head
+-- to spread the workers. Requires PostgreSQL 9.5 or later: the query is
+-- executed dynamically so the function can still be created on older
+-- servers where lock_head must be used instead.
+
+CREATE OR REPLACE FUNCTION lock_head_skip_locked(q_name varchar)
+RETURNS SETOF queue_classic_jobs AS $$
+BEGIN
+  RETURN QUERY SELECT * FROM lock_head_many(q_name, 1);
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+-- lock_head_many claims up to n jobs at the head of the queue, skipping
+-- the rows locked by other transactions. Like queue_classic_head, it walks
+-- the distinct priorities and claims the due jobs of each one with a range
+-- scan, in a single statement per priority.
+-- Requires PostgreSQL 9.5 or later, see lock_head_skip_locked.
+
+CREATE OR REPLACE FUNCTION lock_head_many(q_name varchar, n integer)
+RETURNS SETOF queue_classic_jobs AS $$
+DECLARE
+  relation text := queue_classic_relation(q_name);
+  prio bigint := -2147483649;
+  job queue_classic_jobs;
+BEGIN
+  WHILE n > 0 LOOP
+    EXECUTE 'SELECT priority FROM ' || relation
+      || ' WHERE q_name = $1 AND locked_at IS NULL AND priority > $2'
+      || ' ORDER BY priority LIMIT 1'
+    INTO prio
+    USING q_name, prio;
+    EXIT WHEN prio IS NULL;
+    FOR job IN EXECUTE 'UPDATE ' || relation
+      || ' SET locked_at = (CURRENT_TIMESTAMP), locked_by = pg_backend_pid()'
+      || ' WHERE id IN ('
+      || '   SELECT id FROM ' || relation
+      || '   WHERE locked_at IS NULL'
+      || '   AND q_name = $1 AND priority = $2'
+      || '   AND run_at <= now()'
+      || '   ORDER BY run_at, id'
+      || '   LIMIT $3'
+      || '   FOR UPDATE SKIP LOCKED'
+      || ' )'
+      || ' RETURNING *'
+      USING q_name, prio, n
+    LOOP
+      RETURN NEXT job;
+      n := n - 1;
+    END LOOP;
+  END LOOP;
+
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+-- lock_head_multi claims up to n jobs at the head of the first queue of
+-- q_names which has available jobs, so a worker processing several queues
+-- needs a single round trip whatever the number of queues.
+-- Requires PostgreSQL 9.5 or later, see lock_head_skip_locked.
+
+CREATE OR REPLACE FUNCTION lock_head_multi(q_names varchar[], n integer)
+RETURNS SETOF queue_classic_jobs AS $$
+BEGIN
+  FOR i IN 1 .. coalesce(array_length(q_names, 1), 0) LOOP
+    RETURN QUERY SELECT * FROM lock_head_many(q_names[i], n);
+    IF FOUND THEN
+      RETURN;
+    END IF;
+  END LOOP;
+
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+-- queue_classic_next_run_at returns the earliest run_at of the unlocked
+-- jobs of q_names, so idle workers can sleep until a scheduled job is due.
+-- The distinct priorities are walked with a recursive query so that each
+-- step is a lookup in the (q_name, priority, run_at, id) index, however
+-- many jobs are scheduled.
+
+CREATE OR REPLACE FUNCTION queue_classic_next_run_at(q_names varchar[])
+RETURNS timestamptz AS $$
+DECLARE
+  relation text;
+  next_run_at timestamptz;
+  result timestamptz;
+BEGIN
+  FOR i IN 1 .. coalesce(array_length(q_names, 1), 0) LOOP
+    relation := queue_classic_relation(q_names[i]);
+    EXECUTE 'WITH RECURSIVE priorities(priority) AS ('
+      || '  (SELECT priority FROM ' || relation
+      || '   WHERE q_name = $1 AND locked_at IS NULL'
+      || '   ORDER BY priority LIMIT 1)'
+      || '  UNION ALL'
+      || '  SELECT (SELECT j.priority FROM ' || relation || ' j'
+      || '          WHERE j.q_name = $1 AND j.locked_at IS NULL'
+      || '          AND j.priority > p.priority'
+      || '          ORDER BY j.priority LIMIT 1)'
+      || '  FROM priorities p WHERE p.priority IS NOT NULL'
+      || ')'
+      || ' SELECT min((SELECT j.run_at FROM ' || relation || ' j'
+      || '             WHERE j.q_name = $1 AND j.locked_at IS NULL'
+      || '             AND j.priority = p.priority'
+      || '             ORDER BY j.run_at LIMIT 1))'
+      || ' FROM priorities p WHERE p.priority IS NOT NULL'
+    INTO next_run_at
+    USING q_names[i];
+    IF result IS NULL OR next_run_at < result THEN
+      result := next_run_at;
+    END IF;
+  END LOOP;
+
+  RETURN result;
+END;
+$$ LANGUAGE plpgsql;
+
+-- queue_classic_heartbeat registers the worker locking jobs with the
+-- connection of backend pid, or updates its heartbeat.
+
+CREATE OR REPLACE FUNCTION queue_classic_heartbeat(pid integer,
+  q_names text[], host text, os_pid integer)
+RETURNS void AS $$
+BEGIN
+  UPDATE queue_classic_workers w SET heartbeat_at = now()
+  WHERE w.pid = $1;
+  IF NOT FOUND THEN
+    INSERT INTO queue_classic_workers (pid, q_names, host, os_pid)
+    VALUES ($1, $2, $3, $4);
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- queue_classic_reap unlocks the jobs of the dead workers: the workers
+-- whose heartbeat is older than stale or whose connection is gone. The
+-- jobs locked by unregistered clients are left to the lock timeouts (see
+-- queue_classic_unlock_expired): a pooled client may close the connection
+-- it locked a job with while still running it. Only the (few) locked jobs
+-- are looked at, through the partial index on locked_at.
+-- The queues of the unlocked jobs are notified. Returns the number of
+-- unlocked jobs.
+
+CREATE OR REPLACE FUNCTION queue_classic_reap(stale interval)
+RETURNS bigint AS $$
+DECLARE
+  reaped bigint;
+  q_names text[];
+BEGIN
+  WITH dead AS (
+    DELETE FROM queue_classic_workers w
+    WHERE w.heartbeat_at < now() - stale
+    OR NOT EXISTS (SELECT 1 FROM pg_stat_activity a WHERE a.pid = w.pid)
+    RETURNING w.pid
+  ), unlocked AS (
+    UPDATE queue_classic_jobs j SET locked_at = NULL, locked_by = NULL
+    WHERE j.locked_at IS NOT NULL
+    AND j.locked_by IN (SELECT d.pid FROM dead d)
+    RETURNING j.q_name
+  )
+  SELECT count(*), array_agg(DISTINCT u.q_name) INTO reaped, q_names
+  FROM unlocked u;
+
+  PERFORM pg_notify(q, '') FROM unnest(q_names) q;
+  RETURN reaped;
+END;
+$$ LANGUAGE plpgsql;
+
+-- queue_classic_unlock_expired unlocks the jobs of a queue locked for
+-- longer than timeout, whoever locked them, and notifies the queue.
+-- Returns the number of unlocked jobs.
+
+CREATE OR REPLACE FUNCTION queue_classic_unlock_expired(q_name varchar,
+  timeout interval)
+RETURNS bigint AS $$
+DECLARE
+  reaped bigint;
+BEGIN
+  EXECUTE 'WITH unlocked AS ('
+    || ' UPDATE ' || queue_classic_relation(q_name)
+    || ' SET locked_at = NULL, locked_by = NULL'
+    || ' WHERE q_name = $1 AND locked_at < now() - $2'
+    || ' RETURNING id'
+    || ') SELECT count(*) FROM unlocked'
+  INTO reaped
+  USING q_name, timeout;
+
+  IF reaped > 0 THEN
+    PERFORM pg_notify(q_name, '');
+  END IF;
+  RETURN reaped;
+END;
+$$ LANGUAGE plpgsql;
+
+-- queue_classic_unlock_expired_others unlocks the jobs of the queues other
+-- than q_names (which have lock timeouts of their own) locked for longer
+-- than timeout, whoever locked them, dedicated tables included, and
+-- notifies their queues. Returns the number of unlocked jobs.
+
+CREATE OR REPLACE FUNCTION queue_classic_unlock_expired_others(
+  timeout interval, q_names varchar[])
+RETURNS bigint AS $$
+DECLARE
+  reaped bigint;
+  unlocked_q_names text[];
+BEGIN
+  WITH unlocked AS (
+    UPDATE queue_classic_jobs j SET locked_at = NULL, locked_by = NULL
+    WHERE j.locked_at < now() - timeout
+    AND j.q_name <> ALL(coalesce(q_names, '{}'))
+    RETURNING j.q_name
+  )
+  SELECT count(*), array_agg(DISTINCT u.q_name)
+  INTO reaped, unlocked_q_names
+  FROM unlocked u;
+
+  PERFORM pg_notify(q, '') FROM unnest(unlocked_q_names) q;
+  RETURN reaped;
+END;
+$$ LANGUAGE plpgsql;
+
+-- queue_classic_fail records the failure of the jobs ids, errors giving the
+-- error of each job. The jobs which reached max_attempts attempts are moved
+-- to queue_classic_failed_jobs. The others are unlocked and their run_at is
+-- pushed back by backoff * 2 ^ (attempts - 1) seconds, at most max_backoff
+-- seconds. Returns the number of jobs moved to queue_classic_failed_jobs.
+
+CREATE OR REPLACE FUNCTION queue_classic_fail(ids bigint[], errors text[],
+  max_attempts integer, backoff double precision,
+  max_backoff double precision)
+RETURNS bigint AS $$
+DECLARE
+  moved bigint;
+  q_names text[];
+BEGIN
+  WITH failed AS (
+    SELECT unnest(ids) AS id, unnest(errors) AS error
+  ), dead AS (
+    DELETE FROM queue_classic_jobs j USING failed f
+    WHERE j.id = f.id AND j.attempts + 1 >= max_attempts
+    RETURNING j.*, f.error
+  ), inserted AS (
+    INSERT INTO queue_classic_failed_jobs (id, q_name, method, args,
+      locked_at, created_at, priority, run_at, locked_by, attempts,
+      last_error, data, external)
+    SELECT d.id, d.q_name, d.method, d.args, d.locked_at, d.created_at,
+      d.priority, d.run_at, d.locked_by, d.attempts + 1, d.error, d.data,
+      d.external
+    FROM dead d
+    RETURNING 1
+  ), retried AS (
+    UPDATE queue_classic_jobs j
+    SET locked_at = NULL, locked_by = NULL,
+      attempts = j.attempts + 1, last_error = f.error,
+      run_at = now() + least(max_backoff, backoff * 2 ^ j.attempts)
+        * interval '1 second'
+    FROM failed f
+    WHERE j.id = f.id AND j.attempts + 1 < max_attempts
+    RETURNING j.q_name
+  )
+  SELECT (SELECT count(*) FROM inserted),
+    (SELECT array_agg(DISTINCT r.q_name) FROM retried r)
+  INTO moved, q_names;
+
+  PERFORM pg_notify(q, '') FROM unnest(q_names) q;
+  RETURN moved;
+END;
+$$ LANGUAGE plpgsql;
+
+-- queue_classic_estimate returns the number of rows the planner expects
+-- query to return. Planning is cheap and does not depend on the number of
+-- rows, but estimates are only as good as the statistics of the tables,
+-- and they are never lower than 1.
+
+CREATE OR REPLACE FUNCTION queue_classic_estimate(query text)
+RETURNS bigint AS $$
+DECLARE
+  line text;
+BEGIN
+  FOR line IN EXECUTE 'EXPLAIN ' || query LOOP
+    RETURN substring(line FROM ' rows=([0-9]+)')::bigint;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- queue_classic_stats returns the number of ready (unlocked and due),
+-- locked and total jobs of q_names, or of every queue if q_names is null.
+-- Locked jobs are counted through the partial index on locked_at, which
+-- only holds a handful of rows. Unless exact is true, the ready and
+-- unlocked jobs are estimated by the planner instead of being counted.
+-- The names of the queues are found with loose scans of the partial
+-- indexes, which cost an index lookup per queue.
+
+CREATE OR REPLACE FUNCTION queue_classic_stats(q_names varchar[],
+  exact boolean)
+RETURNS TABLE (q_name text, ready bigint, locked bigint, total bigint) AS $$
+#variable_conflict use_column
+DECLARE
+  relation text;
+  condition text;
+BEGIN
+  IF q_names IS NULL THEN
+    WITH RECURSIVE unlocked_names(n) AS (
+      (SELECT j.q_name FROM ONLY queue_classic_jobs j
+       WHERE j.locked_at IS NULL ORDER BY j.q_name LIMIT 1)
+      UNION ALL
+      SELECT (SELECT j.q_name FROM ONLY queue_classic_jobs j
+              WHERE j.locked_at IS NULL AND j.q_name > u.n
+              ORDER BY j.q_name LIMIT 1)
+      FROM unlocked_names u WHERE u.n IS NOT NULL
+    ), locked_names(n) AS (
+      (SELECT j.q_name FROM ONLY queue_classic_jobs j
+       WHERE j.locked_at IS NOT NULL ORDER BY j.q_name LIMIT 1)
+      UNION ALL
+      SELECT (SELECT j.q_name FROM ONLY queue_classic_jobs j
+              WHERE j.locked_at IS NOT NULL AND j.q_name > l.n
+              ORDER BY j.q_name LIMIT 1)
+      FROM locked_names l WHERE l.n IS NOT NULL
+    )
+    SELECT array_agg(names.n ORDER BY names.n) INTO q_names FROM (
+      SELECT u.n FROM unlocked_names u WHERE u.n IS NOT NULL
+      UNION SELECT l.n FROM locked_names l WHERE l.n IS NOT NULL
+      UNION SELECT t.q_name FROM queue_classic_tables t
+    ) names;
+  END IF;
+
+  FOR i IN 1 .. coalesce(array_length(q_names, 1), 0) LOOP
+    q_name := q_names[i];
+    relation := queue_classic_relation(q_name);
+    condition := ' WHERE q_name = ' || quote_literal(q_name)
+      || ' AND locked_at IS NULL';
+    EXECUTE 'SELECT count(*) FROM ' || relation
+      || ' WHERE q_name = $1 AND locked_at IS NOT NULL'
+    INTO locked
+    USING q_name;
+    IF exact THEN
+      EXECUTE 'SELECT count(*),'
+        || ' coalesce(sum(CASE WHEN run_at <= now() THEN 1 ELSE 0 END), 0)'
+        || ' FROM ' || relation || condition
+      INTO total, ready;
+    ELSE
+      total := queue_classic_estimate(
+        'SELECT 1 FROM ' || relation || condition);
+      ready := queue_classic_estimate(
+        'SELECT 1 FROM ' || relation || condition || ' AND run_at <= now()');
+    END IF;
+    total := total + locked;
+    RETURN NEXT;
+  END LOOP;
+
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
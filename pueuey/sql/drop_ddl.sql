@@ -1,3 +1,18 @@
+DROP FUNCTION IF EXISTS queue_classic_stats(q_names varchar[], exact boolean);
+DROP FUNCTION IF EXISTS queue_classic_estimate(query text);
+DROP FUNCTION IF EXISTS queue_classic_fail(ids bigint[], errors text[], max_attempts integer, backoff double precision, max_backoff double precision);
+DROP FUNCTION IF EXISTS queue_classic_unlock_expired(q_name varchar, timeout interval);
+DROP FUNCTION IF EXISTS queue_classic_unlock_expired_others(timeout interval, q_names varchar[]);
+DROP FUNCTION IF EXISTS queue_classic_reap(stale interval);
+DROP FUNCTION IF EXISTS queue_classic_heartbeat(pid integer, q_names text[], host text, os_pid integer);
+DROP FUNCTION IF EXISTS queue_classic_next_run_at(q_names varchar[]);
+DROP FUNCTION IF EXISTS lock_head_multi(q_names varchar[], n integer);
+DROP FUNCTION IF EXISTS queue_classic_dedicate(q_name varchar);
+DROP FUNCTION IF EXISTS queue_classic_route() cascade;
+DROP FUNCTION IF EXISTS lock_head_many(q_name varchar, n integer);
+DROP FUNCTION IF EXISTS lock_head_skip_locked(q_name varchar);
+DROP FUNCTION IF EXISTS queue_classic_head(q_name varchar, n integer);
 DROP FUNCTION IF EXISTS lock_head(tname varchar);
 DROP FUNCTION IF EXISTS lock_head(q_name varchar, top_boundary integer);
 DROP FUNCTION IF EXISTS queue_classic_notify() cascade;
+DROP FUNCTION IF EXISTS queue_classic_relation(q_name varchar);
@@ -1,12 +1,24 @@
 import os
 import sys
-import datetime
-import importlib
+import time
+import errno
+import random
+import signal
+import socket
+import resource
+import collections
+import copy
+import threading
+import Queue as thread_queue
 import psycopg2
 
-from log import log, log_yield, _logger
+from log import log, log_yield, monotonic, _logger
 from conn_adapter import ConnAdapter
-from queue import Queue
+from queue import Queue, AdaptiveTopBound
+from dispatch import Dispatcher
+from reaper import Reaper
+from metrics import get_default as get_default_metrics
+from serializers import get_default as get_default_serializer
 
 __all__ = ['Worker']
 
@@ -22,14 +34,119 @@ class Worker(object):
     # q_name:: Name of a single queue to process.
     # q_names:: Names of queues to process. Will process left to right.
     # top_bound:: Offset to the head of the queue. 1 == strict FIFO.
+    #             'auto' adapts it to the contention, see AdaptiveTopBound
+    #             (it needs heartbeats, see heartbeat_interval).
+    # skip_locked:: Lock jobs with FOR UPDATE SKIP LOCKED. See Queue.
+    # prefetch:: Number of jobs locked at once. The jobs are kept in memory
+    #            and processed before the worker goes back to the database.
+    # delete_batch:: Number of finished jobs deleted at once.
+    # delete_interval:: Maximum time (in seconds) a finished job waits
+    #                   before being deleted.
+    # threads:: Number of threads executing the jobs. The jobs are locked by
+    #           the thread calling Worker#start and each executor thread
+    #           uses its own connection (see Worker#setup_thread).
+    # processes:: Number of long-lived child processes forked in advance by
+    #             Worker#start, which then supervises them.
+    # max_jobs:: Number of jobs after which a child process is recycled.
+    # max_rss:: Growth of the maximum resident set size of a child process
+    #           (as reported by getrusage, in kilobytes on Linux) after
+    #           which it is recycled.
+    # dispatch_cache:: Number of resolved methods kept in cache.
+    # prewarm:: Methods resolved (and their modules imported) when the worker
+    #           starts.
+    # metrics:: Metrics sink of the worker and its queues, by default the one
+    #           given by pueuey.metrics.get_default().
+    # max_attempts:: Number of times a job is attempted before it is moved to
+    #                the dead-letter table, see Worker#handle_failure.
+    # retry_backoff:: Delay (in seconds) before the first retry of a failed
+    #                 job, doubled after each attempt.
+    # max_retry_backoff:: Maximum delay before the retry of a failed job.
+    # serializer:: Serializer of the args of the jobs of the worker's queues,
+    #              see pueuey.serializers. With a Raw serializer, each job is
+    #              called with its undecoded args as only argument.
+    # payload_store:: Store of the payloads of the jobs stored out of line,
+    #                 see pueuey.payloads.
+    # connect:: Function returning a new psycopg2 connection, used for the
+    #           connections the worker opens besides its own (heartbeats,
+    #           pre-forked children, executor threads, listener of a
+    #           GreenWorker), see Worker#new_connection.
+    # heartbeat_interval:: Time between two heartbeats of the worker, see
+    #                     Worker#start_heartbeat. 0 disables them.
+    # reap_interval:: Time between two reaps by the heartbeat thread of the
+    #                 worker, see Reaper. 0 disables them.
+    # weights:: Weights of the queues given by q_names. When set, the order
+    #           in which the queues are tried is drawn at random for each
+    #           lock, a queue coming first in proportion to its weight,
+    #           instead of strictly left to right.
     def __init__(self, fork_worker=None, wait_interval=None, connection=None,
-                 q_name=None, q_names=None, top_bound=None):
+                 q_name=None, q_names=None, top_bound=None, skip_locked=None,
+                 prefetch=None, delete_batch=None, delete_interval=None,
+                 threads=None, processes=None, max_jobs=None, max_rss=None,
+                 dispatch_cache=None, prewarm=None, metrics=None,
+                 weights=None, heartbeat_interval=None, reap_interval=None,
+                 max_attempts=None, retry_backoff=None,
+                 max_retry_backoff=None, serializer=None,
+                 payload_store=None, connect=None):
         if fork_worker is None:
             fork_worker = bool(os.environ.get('QC_FORK_WORKER', ''))
         if wait_interval is None:
             wait_interval = int(os.environ.get('QC_LISTEN_TIME', '5'))
+        if prefetch is None:
+            prefetch = int(os.environ.get('QC_PREFETCH', '1'))
+        if delete_batch is None:
+            delete_batch = int(os.environ.get('QC_DELETE_BATCH', '1'))
+        if delete_interval is None:
+            delete_interval = float(os.environ.get('QC_DELETE_INTERVAL', '1'))
+        if threads is None:
+            threads = int(os.environ.get('QC_THREADS', '0'))
+        if processes is None:
+            processes = int(os.environ.get('QC_PROCESSES', '0'))
+        if max_jobs is None:
+            max_jobs = int(os.environ.get('QC_MAX_JOBS', '0'))
+        if max_rss is None:
+            max_rss = int(os.environ.get('QC_MAX_RSS', '0'))
+        if max_attempts is None:
+            max_attempts = int(os.environ.get('QC_MAX_ATTEMPTS', '1'))
+        if retry_backoff is None:
+            retry_backoff = float(os.environ.get('QC_RETRY_BACKOFF', '10'))
+        if max_retry_backoff is None:
+            max_retry_backoff = float(
+                os.environ.get('QC_MAX_RETRY_BACKOFF', '3600'))
+        if heartbeat_interval is None:
+            heartbeat_interval = float(
+                os.environ.get('QC_HEARTBEAT_INTERVAL', '10'))
+        if reap_interval is None:
+            reap_interval = float(os.environ.get('QC_REAP_INTERVAL', '30'))
+        if prewarm is None:
+            prewarm = [m for m in os.environ.get('QC_PREWARM', '').split(',')
+                       if m]
         self.fork_worker = fork_worker
         self.wait_interval = wait_interval
+        self.prefetch = prefetch
+        self.prefetched = collections.deque()
+        self.delete_batch = delete_batch
+        self.delete_interval = delete_interval
+        self.completed = collections.defaultdict(list)
+        self.failed = collections.defaultdict(list)
+        self.completed_count = 0
+        self.completed_since = None
+        self.due_at = None
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.threads = threads
+        self.processes = processes
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.heartbeat_interval = heartbeat_interval
+        self.reap_interval = reap_interval
+        self.heartbeat_thread = None
+        self.dispatcher = Dispatcher(dispatch_cache, self.__module__)
+        self.prewarm = prewarm
+        self.metrics = metrics or get_default_metrics()
+        self.serializer = serializer or get_default_serializer()
+        self.connect = connect
+        self.owns_connection = connection is None
         self.conn_adapter = ConnAdapter(connection)
         if q_name is None:
             q_name = os.environ.get('QUEUE', 'default')
@@ -39,8 +156,20 @@ class Worker(object):
                 q_names = []
             else:
                 q_names = q_names.split(',')
+        if weights is None:
+            weights = os.environ.get('QC_QUEUE_WEIGHTS', '')
+            weights = [float(w) for w in weights.split(',') if w]
         self.queues = self.__setup_queues(
-            self.conn_adapter, q_name, q_names, top_bound)
+            self.conn_adapter, q_name, q_names, top_bound, skip_locked,
+            self.metrics, self.serializer, payload_store)
+        if weights and len(weights) != len(self.queues):
+            raise ValueError("one weight per queue is expected")
+        if heartbeat_interval <= 0 and any(
+                isinstance(queue.top_bound, AdaptiveTopBound)
+                for queue in self.queues):
+            _logger.warning("at=top-bound-without-heartbeat "
+                            "error='the workers are not counted'")
+        self.weights = weights
         self.running = True
         log(at="worker_initialized")
 
@@ -49,12 +178,27 @@ class Worker(object):
     # This method is the primary entry point to starting the worker.
     # The canonical example of starting a worker is as follows:
     # QC::Worker.new.start
+    # Jobs which have been prefetched but not processed are unlocked and
+    # finished jobs which have not been deleted yet are deleted when
+    # the worker stops.
     def start(self):
-        while self.running:
-            if self.fork_worker:
-                self.fork_and_work()
+        self.dispatcher.prewarm(self.prewarm)
+        try:
+            if self.processes > 0:
+                self.prefork_and_work()
             else:
-                self.work()
+                self.start_heartbeat()
+                if self.threads > 0:
+                    self.thread_and_work()
+            while self.running:
+                if self.fork_worker:
+                    self.fork_and_work()
+                else:
+                    self.work()
+        finally:
+            self.flush_completed()
+            self.unlock_prefetched()
+            self.stop_heartbeat()
 
     # Signals the worker to stop taking new work.
     # This method has no immediate effect. However, there are
@@ -68,12 +212,18 @@ class Worker(object):
 
     # Calls Worker#work but after the current process is forked.
     # The parent process will wait on the child process to exit.
+    # The child process processes only one job: the other jobs it may
+    # have prefetched are unlocked before it exits.
     def fork_and_work(self):
         cpid = os.fork()
         if cpid == 0:
             try:
                 self.setup_child()
-                self.work()
+                try:
+                    self.work()
+                finally:
+                    self.flush_completed()
+                    self.unlock_prefetched()
             except:
                 # prevent going up in the stack
                 os._exit(1)
@@ -81,15 +231,186 @@ class Worker(object):
                 # prevent going up in the stack
                 os._exit(0)
         else:
-            log(at="fork", pid=str(cpid))
+            log(at="fork", pid=cpid)
             os.waitpid(cpid, 0)
 
+    # Forks processes child processes which work until they are stopped or
+    # recycled (see max_jobs and max_rss) and respawns them until the worker
+    # is stopped. Each child sets up its own connection: Worker#setup_child
+    # is called first and, if it did not replace the connection, a new one
+    # is opened by Worker#new_connection.
+    # SIGTERM and SIGQUIT received by the supervisor stop it and are
+    # forwarded to the children. A child finishes its current job on SIGTERM
+    # and exits immediately on SIGQUIT.
+    def prefork_and_work(self):
+        children = set()
+
+        def forward(signum, frame):
+            self.stop()
+            for pid in children:
+                try:
+                    os.kill(pid, signum)
+                except OSError:
+                    pass
+
+        handlers = dict((signum, signal.signal(signum, forward))
+                        for signum in (signal.SIGTERM, signal.SIGQUIT))
+        try:
+            while self.running:
+                while self.running and len(children) < self.processes:
+                    children.add(self.__spawn_child())
+                pid, status = self.__wait_child()
+                if pid is None:
+                    continue
+                children.discard(pid)
+                if status:
+                    log(at="child_crashed", pid=pid, status=status)
+                    if self.running:
+                        time.sleep(1)
+        finally:
+            self.running = False
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            while children:
+                pid, status = self.__wait_child()
+                children.discard(pid)
+
+    def __wait_child(self):
+        try:
+            return os.wait()
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+            return (None, None)
+
+    def __spawn_child(self):
+        cpid = os.fork()
+        if cpid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, lambda *a: self.stop())
+                signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+                connection = self.conn_adapter.connection
+                self.setup_child()
+                if self.conn_adapter.connection is connection:
+                    # NOTE: the connection of the supervisor must not be
+                    #       garbage collected, it would be closed
+                    self.__supervisor_conn_adapter = self.conn_adapter
+                    self.__reconnect()
+                self.start_heartbeat()
+                try:
+                    self.__work_until_recycled()
+                finally:
+                    self.stop_heartbeat()
+            except Exception, e:
+                log(at="child_error", error=repr(e))
+                status = 1
+            finally:
+                # prevent going up in the stack
+                os._exit(status)
+        log(at="fork", pid=cpid)
+        return cpid
+
+    def __work_until_recycled(self):
+        jobs = 0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        try:
+            while self.running:
+                self.work()
+                jobs += 1
+                if self.max_jobs and jobs >= self.max_jobs:
+                    log(at="recycle", jobs=jobs)
+                    break
+                growth = \
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+                if self.max_rss and growth >= self.max_rss:
+                    log(at="recycle", rss=growth)
+                    break
+        finally:
+            self.flush_completed()
+            self.unlock_prefetched()
+
+    # Locks jobs and hands them to a pool of executor threads until the
+    # worker is stopped. The jobs are buffered in a queue of the size of
+    # the pool: the jobs still waiting in it when the worker stops are
+    # unlocked, the jobs being processed are finished.
+    def thread_and_work(self):
+        jobs = thread_queue.Queue(self.threads)
+        executors = [threading.Thread(target=self.__execute, args=(jobs,))
+                     for i in range(self.threads)]
+        for executor in executors:
+            executor.daemon = True
+            executor.start()
+        log(at="thread_and_work", threads=self.threads)
+        try:
+            while self.running:
+                locked = self.lock_job()
+                while locked and self.running:
+                    try:
+                        jobs.put(locked, timeout=self.wait_interval)
+                        locked = None
+                    except thread_queue.Full:
+                        pass
+                if locked:
+                    self.prefetched.append(locked)
+        finally:
+            self.running = False
+            while True:
+                try:
+                    self.prefetched.append(jobs.get_nowait())
+                except thread_queue.Empty:
+                    break
+            for executor in executors:
+                jobs.put(None)
+            for executor in executors:
+                executor.join()
+
+    def __execute(self, jobs):
+        try:
+            worker = copy.copy(self)
+            worker.prefetched = collections.deque()
+            worker.completed = collections.defaultdict(list)
+            worker.failed = collections.defaultdict(list)
+            worker.completed_count = 0
+            worker.setup_thread()
+        except Exception, e:
+            log(at="thread_error", error=repr(e))
+            self.stop()
+            raise
+        queues = dict((queue.name, queue) for queue in worker.queues)
+        try:
+            while True:
+                # NOTE: an idle thread still deletes its finished jobs
+                try:
+                    locked = jobs.get(timeout=worker.delete_interval
+                                      if worker.completed_count else None)
+                except thread_queue.Empty:
+                    worker.flush_expired()
+                    continue
+                if locked is None:
+                    break
+                queue, job = locked
+                log(at="work", job=job['id'])
+                worker.process(queues[queue.name], job)
+        except Exception, e:
+            log(at="thread_error", error=repr(e))
+            self.stop()
+            raise
+        finally:
+            worker.flush_completed()
+            worker.conn_adapter.disconnect()
+
     # Blocks on locking a job, and once a job is locked,
     # it will process the job.
     def work(self):
-        queue, job = self.lock_job()
+        queue, job = self.lock_job() or (None, None)
         if queue and job:
-            log(at="work", job=str(job['id']))
+            log(at="work", job=job['id'])
             self.process(queue, job)
 
     # Attempt to lock a job in the queue's table.
@@ -99,30 +420,76 @@ class Worker(object):
     # If a job is returned, its locked_at column has been set in the
     # job's row. It is the caller's responsibility to delete the job row
     # from the table when the job is complete.
+    # When prefetch is greater than 1, up to prefetch jobs are locked at
+    # once and the following calls return them until none is left.
+    # The worker stays subscribed to the queues' channels: the notifications
+    # received while it was locking or processing jobs wake it immediately.
     def lock_job(self):
         log(at="lock_job")
-        job = None
+        subscription = self.conn_adapter.subscribe(
+            *[queue.name for queue in self.queues])
         while self.running:
-            for queue in self.queues:
-                job = queue.lock()
-                if job:
-                    return (queue, job)
-            self.conn_adapter.wait(self.wait_interval,
-                *[queue.name for queue in self.queues])
+            if subscription.poll():
+                self.due_at = None
+            subscription.clear()
+            locked = self.try_lock_job()
+            if locked:
+                return locked
+            self.flush_completed()
+            start = monotonic()
+            if subscription.wait(self.wait_time()) is not None:
+                self.due_at = None
+            self.metrics.timing('qc.idle-wait', monotonic() - start)
+
+    # Attempt to lock a job in each queue once, without waiting.
+    # All the queues are tried in a single query, see Queue.lock_first.
+    # Returns None if no job could be locked. See Worker#lock_job.
+    def try_lock_job(self):
+        if self.prefetched:
+            return self.prefetched.popleft()
+        jobs = Queue.lock_first(self.ordered_queues(), self.prefetch)
+        if not jobs:
+            return None
+        self.prefetched.extend(jobs[1:])
+        return jobs[0]
+
+    # Returns the time to wait for a notification before trying to lock a
+    # job again: wait_interval, or less if a scheduled job is due before.
+    # The time the next scheduled job is due (due_at, on the monotonic
+    # clock) is cached: it is looked up again only once it has passed or
+    # after a notification, which resets it to None, so an idle worker
+    # does not query it on every loop.
+    def wait_time(self):
+        now = monotonic()
+        if self.due_at is None or self.due_at <= now:
+            due_in = Queue.due_in(self.queues)
+            self.due_at = float('inf') if due_in is None else now + due_in
+        return max(0.0, min(self.due_at - now, self.wait_interval))
+
+    # Returns the queues in the order they are tried by Worker#try_lock_job:
+    # left to right or, with weights, in a random order where each queue
+    # comes first with a probability proportional to its weight.
+    def ordered_queues(self):
+        if not self.weights:
+            return self.queues
+        keys = [random.random() ** (1.0 / weight) for weight in self.weights]
+        return [queue for key, queue in
+                sorted(zip(keys, self.queues), key=lambda kq: -kq[0])]
 
     # A job is processed by evaluating the target code.
     # if the job is evaluated with no exceptions
-    # then it is deleted from the queue.
+    # then it is deleted from the queue (see Worker#complete).
     # If the job has raised an exception the responsibility of what
     # to do with the job is delegated to Worker#handle_failure.
     # If the job is not finished and an INT signal is trapped,
     # this method will unlock the job in the queue.
     def process(self, queue, job):
-        start = datetime.datetime.now()
+        self.flush_expired()
+        start = monotonic()
         finished = False
         try:
             self.call(job)
-            queue.delete(job['id'])
+            self.complete(queue, job['id'])
             finished = True
         except Exception, e:
             self.handle_failure(job, e)
@@ -130,28 +497,110 @@ class Worker(object):
         finally:
             if not finished:
                 queue.unlock(job['id'])
-            ttp = datetime.datetime.now() - start
-            _logger.info("measure#qc.time-to-process=%s source=%s"
-                         % (int(ttp.microseconds / 1000), queue.name))
+            self.metrics.timing('qc.time-to-process', monotonic() - start,
+                                source=queue.name)
 
     # Each job includes a method column. We will use ruby's eval
     # to grab the ruby object from memory. We send the method to
     # the object and pass the args.
+    # The method is resolved by the worker's Dispatcher which caches it.
     def call(self, job):
         args = job['args']
-        receiver_str, _, message = job['method'].rpartition('.')
-        if receiver_str:
-            module = importlib.import_module(receiver_str, self.__module__)
+        if self.serializer.raw:
+            args = [args]
+        self.dispatcher.resolve(job['method'])(*args)
+
+    # Registers a callable for a method name, to use as a decorator:
+    #   @worker.task("mail.send")
+    #   def send(to, subject): ...
+    def task(self, name):
+        return self.dispatcher.task(name)
+
+    # Marks a job as finished. The finished jobs are deleted by batches of
+    # delete_batch jobs, or once the oldest one has waited delete_interval
+    # seconds, whichever comes first.
+    def complete(self, queue, id):
+        self.completed[queue].append(id)
+        self.__finished()
+
+    # Records the failure of a job, to retry it or to move it to the
+    # dead-letter table (see Queue#fail_many). Like the deletions, the
+    # failures are recorded by batches.
+    def fail(self, queue, id, error):
+        self.failed[queue].append((id, error))
+        self.__finished()
+
+    def __finished(self):
+        if not self.completed_count:
+            self.completed_since = time.time()
+        self.completed_count += 1
+        if self.completed_count >= self.delete_batch:
+            self.__flush()
         else:
-            import __main__
-            module = __main__
-        getattr(module, message)(*args)
+            self.flush_expired()
+
+    # Flushes the finished jobs if the oldest one has waited delete_interval
+    # seconds. Called before each job starts, so that a long job does not
+    # delay the deletion of the jobs finished before it.
+    def flush_expired(self):
+        if (self.completed_count and
+                time.time() - self.completed_since >= self.delete_interval):
+            self.__flush()
+
+    # The flushes done around the processing of a job must not fail it: the
+    # error is logged and the finished jobs are flushed again later.
+    def __flush(self):
+        try:
+            self.flush_completed()
+        except psycopg2.Error, e:
+            log(at="flush_error", error=repr(e))
+
+    # Deletes the finished jobs that have not been deleted yet and records
+    # the failures that have not been recorded yet. If it raises, the jobs
+    # not flushed are kept for the next flush.
+    def flush_completed(self):
+        completed, failed = self.completed, self.failed
+        self.completed = collections.defaultdict(list)
+        self.failed = collections.defaultdict(list)
+        self.completed_count = 0
+        try:
+            for queue in completed.keys():
+                queue.delete_many(completed[queue])
+                del completed[queue]
+            for queue in failed.keys():
+                ids, errors = zip(*failed[queue])
+                queue.fail_many(ids, errors, self.max_attempts,
+                                self.retry_backoff, self.max_retry_backoff)
+                del failed[queue]
+        except:
+            for queue, ids in completed.items():
+                self.completed[queue][:0] = ids
+                self.completed_count += len(ids)
+            for queue, failures in failed.items():
+                self.failed[queue][:0] = failures
+                self.completed_count += len(failures)
+            raise
+
+    # Unlocks the jobs that have been prefetched but not processed yet.
+    def unlock_prefetched(self):
+        ids = collections.defaultdict(list)
+        while self.prefetched:
+            queue, job = self.prefetched.popleft()
+            ids[queue].append(job['id'])
+        for queue, queue_ids in ids.items():
+            queue.unlock_many(queue_ids)
 
     # This method will be called when an exception
     # is raised during the execution of the job.
+    # The job is retried later until it has been attempted max_attempts
+    # times, it is then moved to the queue_classic_failed_jobs table.
     def handle_failure(self, job, e):
-        _logger.error("count#qc.job-error=1 job=%s error=%s"
-                      % (repr(job), repr(e)))
+        self.metrics.increment('qc.job-error', source=job['q_name'])
+        _logger.error("at=job-error job=%r error=%r", job, e)
+        for queue in self.queues:
+            if queue.name == job['q_name']:
+                self.fail(queue, job['id'], repr(e))
+                break
 
     # This method should be overriden if
     # your worker is forking and you need to
@@ -159,12 +608,120 @@ class Worker(object):
     def setup_child(self):
         log(at="setup_child")
 
+    # Registers the worker in queue_classic_workers and starts a daemon
+    # thread which updates its heartbeat every heartbeat_interval seconds
+    # (and reaps the dead workers every reap_interval seconds) until
+    # Worker#stop_heartbeat is called. The thread uses a connection of its
+    # own so that neither long jobs nor the children of a fork_worker delay
+    # the heartbeats. The worker is identified by the backend pid of its
+    # connection, which the lock functions store in the jobs they lock.
+    # The heartbeats also give the adaptive top bounds of the queues the
+    # number of workers registered on them.
+    def start_heartbeat(self):
+        if self.heartbeat_interval <= 0 or self.heartbeat_thread:
+            return
+        pid = self.conn_adapter.connection.get_backend_pid()
+        args = [pid, [queue.name for queue in self.queues],
+                socket.gethostname(), os.getpid()]
+        conn_adapter = ConnAdapter(self.new_connection())
+        conn_adapter.execute(
+            'SELECT queue_classic_heartbeat(%s, %s, %s, %s)', args)
+        self.__count_workers(conn_adapter)
+        self.heartbeat_stopped = threading.Event()
+        self.heartbeat_thread = threading.Thread(
+            target=self.__heartbeat, args=(conn_adapter, args))
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+        log(at="heartbeat_started", pid=pid)
+
+    # Returns a new connection to the database of the worker, from connect
+    # if it was given. Otherwise a worker which established its own
+    # connection establishes it the same way (see ConnAdapter), and a
+    # worker given a connection opens one with the parameters of that
+    # connection.
+    def new_connection(self):
+        if self.connect is not None:
+            return self.connect()
+        if self.owns_connection:
+            return ConnAdapter().connection
+        connection = self.conn_adapter.connection
+        # NOTE: psycopg2 hides the password in dsn, connection.info (2.8)
+        #       gives it back
+        info = getattr(connection, 'info', None)
+        if info is not None and info.password:
+            return psycopg2.connect(connection.dsn, password=info.password)
+        return psycopg2.connect(connection.dsn)
+
+    # Stops the heartbeat thread, which unregisters the worker.
+    def stop_heartbeat(self):
+        if self.heartbeat_thread:
+            self.heartbeat_stopped.set()
+            self.heartbeat_thread.join(self.wait_interval)
+            self.heartbeat_thread = None
+
+    def __heartbeat(self, conn_adapter, args):
+        reaper = None
+        if self.reap_interval > 0:
+            reaper = Reaper(conn_adapter.connection,
+                            interval=self.reap_interval, metrics=self.metrics)
+            next_reap = monotonic()
+        try:
+            while not self.heartbeat_stopped.wait(self.heartbeat_interval):
+                try:
+                    if conn_adapter.connection.closed:
+                        conn_adapter = ConnAdapter(self.new_connection())
+                        if reaper:
+                            reaper.conn_adapter = conn_adapter
+                    conn_adapter.execute(
+                        'SELECT queue_classic_heartbeat(%s, %s, %s, %s)', args)
+                    self.__count_workers(conn_adapter)
+                    if reaper and monotonic() >= next_reap:
+                        reaper.reap()
+                        next_reap = monotonic() + reaper.interval
+                except psycopg2.Error, e:
+                    log(at="heartbeat_error", error=repr(e))
+            conn_adapter.execute(
+                'DELETE FROM queue_classic_workers WHERE pid = %s', args[:1])
+        except psycopg2.Error, e:
+            log(at="heartbeat_error", error=repr(e))
+        finally:
+            conn_adapter.disconnect()
+
+    def __count_workers(self, conn_adapter):
+        bounds = dict((queue.name, queue.top_bound) for queue in self.queues
+                      if isinstance(queue.top_bound, AdaptiveTopBound))
+        if not bounds:
+            return
+        with conn_adapter.cursor(psycopg2.extensions.cursor) as curs:
+            curs.execute('SELECT q_name, count(*) '
+                         'FROM queue_classic_workers, unnest(q_names) q_name '
+                         'WHERE q_name = ANY(%s) GROUP BY q_name',
+                         [bounds.keys()])
+            for name, workers in curs.fetchall():
+                bounds[name].workers = workers
+
+    # This method is called in each executor thread of a threaded worker
+    # (on a copy of the worker) to set up the connection used to delete and
+    # unlock the jobs, opened by Worker#new_connection.
+    def setup_thread(self):
+        log(at="setup_thread")
+        self.__reconnect()
+
+    def __reconnect(self):
+        self.conn_adapter = ConnAdapter(self.new_connection())
+        self.queues = [copy.copy(queue) for queue in self.queues]
+        for queue in self.queues:
+            queue.conn_adapter = self.conn_adapter
+
     def log(self, data):
         log(data)
 
-    def __setup_queues(self, conn_adapter, queue, queues, top_bound):
+    def __setup_queues(self, conn_adapter, queue, queues, top_bound,
+                       skip_locked, metrics, serializer, payload_store):
         names = (queues if len(queues) > 0 else [queue])
-        queues = [Queue(name, top_bound) for name in names]
+        queues = [Queue(name, top_bound, skip_locked, metrics, serializer,
+                        payload_store=payload_store)
+                  for name in names]
         for queue in queues:
             queue.conn_adapter = conn_adapter
         return queues
@@ -16,6 +16,10 @@ setup(
     },
     zip_safe = False,
     install_requires = ['psycopg2'],
+    extras_require = {
+        'green': ['gevent'],
+        'fast': ['ujson', 'msgpack'],
+    },
     classifiers = [
         "Development Status :: 5 - Production/Stable",
         "Topic :: Database",
@@ -0,0 +1,58 @@
+#!/usr/bin/env python2
+
+# Measures the time spent per call by Queue.enqueue, lock, delete and count,
+# with and without server-side prepared statements. Each operation is run
+# against a local database so the figures are dominated by the client
+# overhead and the parsing/planning done by the server. A temporary
+# database is created using createdb/dropdb, as for the tests.
+
+import argparse
+import os
+import time
+
+from pueuey import ConnAdapter, Queue
+from common import connect, temporary_database
+
+
+def bench(dbname, address, calls, prepare):
+    queue = Queue('bench_client', top_bound=1)
+    queue.conn_adapter = ConnAdapter(connect(dbname, **address),
+                                     prepare=prepare)
+    timings = {}
+
+    def measure(name, func, *args):
+        t0 = time.time()
+        results = [func(*args) for i in xrange(calls)]
+        timings[name] = (time.time() - t0) / calls * 1e6
+        return results
+
+    measure('enqueue', queue.enqueue, 'bench.noop', [])
+    jobs = measure('lock', queue.lock)
+    ids = iter([job['id'] for job in jobs])
+    measure('delete', lambda: queue.delete(next(ids)))
+    measure('count', queue.count)
+    queue.conn_adapter.disconnect()
+    return timings
+
+parser = argparse.ArgumentParser(add_help=False)
+parser.add_argument('--help', action='store_true')
+parser.add_argument('--host', '-h', default='localhost')
+parser.add_argument('--port', '-p', type=int, default=5432)
+parser.add_argument('--username', '-U', default=os.environ.get('USER'))
+parser.add_argument('--calls', type=int, default=5000)
+
+def main(args):
+    if args.help:
+        parser.print_help()
+        return
+    address = dict(host=args.host, port=args.port, username=args.username)
+    with temporary_database('bench_pueuey', **address) as dbname:
+        before = bench(dbname, address, args.calls, prepare=False)
+        after = bench(dbname, address, args.calls, prepare=True)
+        print "%10s %18s %18s" % ('operation', 'text (us/call)',
+                                  'prepared (us/call)')
+        for name in ('enqueue', 'lock', 'delete', 'count'):
+            print "%10s %18.1f %18.1f" % (name, before[name], after[name])
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,253 @@
+#!/usr/bin/env python2
+
+# Load generator: producers enqueue jobs while workers lock and process
+# them, for every combination of the numbers of workers and producers,
+# payload sizes, numbers of queues, lock functions and top_bound values
+# given on the command line. For each scenario it reports the throughput,
+# the p50/p99 time to lock (from the qc.time-to-lock metric) and time to
+# process (from the enqueue to the end of the job), the CPU time used by
+# the backends of the benchmark (when PostgreSQL runs on the same host)
+# and the growth of the dead tuples of the jobs tables.
+# The results are saved as JSON, labelled with the current commit, and can
+# be compared with the results of another commit using --compare. A
+# temporary database is created using createdb/dropdb, as for the tests.
+# A scenario whose jobs are not all processed within --timeout seconds is
+# reported as failed.
+
+import argparse
+import datetime
+import itertools
+import json
+import math
+import os
+import subprocess
+import threading
+import time
+
+from pueuey import ConnAdapter, Queue, Worker
+from pueuey.metrics import MemoryMetrics
+from common import connect, temporary_database
+
+
+PARAMS = ['workers', 'producers', 'payload', 'queues', 'skip_locked',
+          'top_bound']
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+# CPU time (in seconds) used so far by the backends pids, None if they are
+# not processes of this host.
+def backends_cpu(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            return None
+        total += int(fields[11]) + int(fields[12])  # utime + stime
+    return float(total) / os.sysconf('SC_CLK_TCK')
+
+def dead_tuples(conn):
+    with conn.cursor() as curs:
+        curs.execute('SELECT pg_stat_clear_snapshot()')
+        curs.execute("SELECT coalesce(sum(n_dead_tup), 0) "
+                     "FROM pg_stat_user_tables "
+                     "WHERE relname LIKE 'queue\\_classic\\_%'")
+        return int(curs.fetchone()[0])
+
+class Producer(threading.Thread):
+    def __init__(self, dbname, address, names, jobs, payload):
+        super(Producer, self).__init__()
+        self.queues = [Queue(name) for name in names]
+        self.conn_adapter = ConnAdapter(connect(dbname, **address))
+        for queue in self.queues:
+            queue.conn_adapter = self.conn_adapter
+        self.jobs, self.payload = jobs, payload
+
+    def run(self):
+        queues = itertools.cycle(self.queues)
+        for i in xrange(self.jobs):
+            next(queues).enqueue('bench.job', [time.time(), self.payload])
+
+class Consumer(threading.Thread):
+    def __init__(self, dbname, address, names, skip_locked, top_bound,
+                 metrics, done):
+        super(Consumer, self).__init__()
+        self.worker = Worker(connection=connect(dbname, **address),
+                             q_names=names, top_bound=top_bound,
+                             skip_locked=skip_locked, wait_interval=1,
+                             metrics=metrics)
+        self.done = done
+
+    def run(self):
+        worker = self.worker
+        while worker.running and not self.done.is_set():
+            worker.work()
+        worker.flush_completed()
+
+def bench(dbname, address, jobs, workers, producers, payload, queues,
+          skip_locked, top_bound, stats_delay, timeout):
+    names = ['bench_load_%d' % i for i in range(queues)]
+    admin = ConnAdapter(connect(dbname, **address))
+    for name in names:
+        queue = Queue(name)
+        queue.conn_adapter = admin
+        queue.delete_all()
+    admin.execute('VACUUM')
+    metrics = MemoryMetrics()
+    done = threading.Event()
+    lock = threading.Lock()
+    latencies = []
+
+    def job(enqueued_at, payload):
+        latency = time.time() - enqueued_at
+        with lock:
+            latencies.append(latency)
+            if len(latencies) == jobs:
+                done.set()
+
+    consumers = [Consumer(dbname, address, names, bool(skip_locked),
+                          top_bound, metrics, done) for i in range(workers)]
+    for consumer in consumers:
+        consumer.worker.task('bench.job')(job)
+    producers = [Producer(dbname, address, names, jobs // producers,
+                          'x' * payload) for i in range(producers)]
+    producers[0].jobs += jobs % len(producers)
+    adapters = ([c.worker.conn_adapter for c in consumers] +
+                [p.conn_adapter for p in producers])
+    pids = [adapter.connection.get_backend_pid() for adapter in adapters]
+
+    dead_before = dead_tuples(admin.connection)
+    cpu_before = backends_cpu(pids)
+    t0 = time.time()
+    for thread in consumers + producers:
+        thread.start()
+    for producer in producers:
+        producer.join()
+    enqueued = time.time() - t0
+    finished = done.wait(timeout)
+    elapsed = time.time() - t0
+    for consumer in consumers:
+        consumer.worker.stop()
+    for consumer in consumers:
+        consumer.join()
+    cpu_after = backends_cpu(pids)
+    for adapter in adapters:
+        adapter.disconnect()
+    if not finished:
+        admin.disconnect()
+        with lock:
+            return {'failed': True, 'processed': len(latencies)}
+    time.sleep(stats_delay)  # the statistics are reported asynchronously
+    dead_after = dead_tuples(admin.connection)
+    admin.disconnect()
+
+    time_to_lock = [t for (name, tags), values in metrics.timings.items()
+                    if name == 'qc.time-to-lock' for t in values]
+    return {
+        'enqueue_rate': jobs / enqueued,
+        'throughput': jobs / elapsed,
+        'time_to_lock_p50': percentile(time_to_lock, 50),
+        'time_to_lock_p99': percentile(time_to_lock, 99),
+        'time_to_process_p50': percentile(latencies, 50),
+        'time_to_process_p99': percentile(latencies, 99),
+        'db_cpu': (None if cpu_before is None or cpu_after is None
+                   else cpu_after - cpu_before),
+        'dead_tuples': dead_after - dead_before,
+    }
+
+def label():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def key(params):
+    return tuple(params[name] for name in PARAMS)
+
+def format_value(value, fmt):
+    return ' ' * (len(fmt % 0.0) - 1) + '-' if value is None else fmt % value
+
+parser = argparse.ArgumentParser(add_help=False)
+parser.add_argument('--help', action='store_true')
+parser.add_argument('--host', '-h', default='localhost')
+parser.add_argument('--port', '-p', type=int, default=5432)
+parser.add_argument('--username', '-U', default=os.environ.get('USER'))
+parser.add_argument('--jobs', type=int, default=5000)
+parser.add_argument('--workers', type=int, nargs='+', default=[1, 10])
+parser.add_argument('--producers', type=int, nargs='+', default=[1])
+parser.add_argument('--payloads', type=int, nargs='+', default=[100])
+parser.add_argument('--queues', type=int, nargs='+', default=[1])
+parser.add_argument('--skip-locked', type=int, nargs='+', default=[1],
+                    choices=[0, 1])
+parser.add_argument('--top-bounds', type=int, nargs='+', default=[9])
+parser.add_argument('--stats-delay', type=float, default=1.0)
+parser.add_argument('--timeout', type=float, default=600.0)
+parser.add_argument('--label', default=None)
+parser.add_argument('--output', default='bench_load.json')
+parser.add_argument('--compare', default=None)
+
+def main(args):
+    if args.help:
+        parser.print_help()
+        return
+    address = dict(host=args.host, port=args.port, username=args.username)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            for scenario in json.load(f)['scenarios']:
+                baseline[key(scenario['params'])] = scenario['results']
+    scenarios = []
+    with temporary_database('bench_pueuey', **address) as dbname:
+        conn = connect(dbname, **address)
+        server_version = conn.server_version
+        conn.close()
+        print "%7s %9s %8s %6s %4s %4s %10s %9s %9s %9s %9s %8s %8s%s" % (
+            'workers', 'producers', 'payload', 'queues', 'skip', 'top',
+            'jobs/s', 'ttl p50', 'ttl p99', 'ttp p50', 'ttp p99', 'cpu (s)',
+            'dead', ' %8s' % 'vs base' if args.compare else '')
+        for values in itertools.product(
+                args.workers, args.producers, args.payloads, args.queues,
+                args.skip_locked, args.top_bounds):
+            params = dict(zip(PARAMS, values))
+            results = bench(dbname, address, args.jobs,
+                            stats_delay=args.stats_delay,
+                            timeout=args.timeout, **params)
+            scenarios.append({'params': params, 'results': results})
+            if results.get('failed'):
+                print "%7d %9d %8d %6d %4d %4d" % values, (
+                    "FAILED: %d/%d jobs processed in %gs"
+                    % (results['processed'], args.jobs, args.timeout))
+                continue
+            line = "%7d %9d %8d %6d %4d %4d %10.1f" % (
+                values + (results['throughput'],))
+            for name in ('time_to_lock_p50', 'time_to_lock_p99',
+                         'time_to_process_p50', 'time_to_process_p99'):
+                line += ' ' + format_value(results[name], '%9.4f')
+            line += ' ' + format_value(results['db_cpu'], '%8.2f')
+            line += ' %8d' % results['dead_tuples']
+            if args.compare:
+                base = baseline.get(key(params))
+                if base and base.get('failed'):
+                    base = None
+                line += ' ' + format_value(
+                    base and results['throughput'] / base['throughput'],
+                    '%7.2fx')
+            print line
+    with open(args.output, 'w') as f:
+        json.dump({
+            'label': args.label or label(),
+            'date': datetime.datetime.utcnow().isoformat() + 'Z',
+            'server_version': server_version,
+            'jobs': args.jobs,
+            'scenarios': scenarios,
+        }, f, indent=2, sort_keys=True)
+    print "results saved to %s" % args.output
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+
+# Compares the lock throughput of lock_head (count + random offset + NOWAIT
+# loop) and lock_head_skip_locked (FOR UPDATE SKIP LOCKED) for different
+# numbers of concurrent workers. A temporary database is created using
+# createdb/dropdb, as for the tests.
+
+import argparse
+import os
+import threading
+import time
+
+from pueuey import ConnAdapter, Queue
+from common import connect, temporary_database
+
+
+class Locker(threading.Thread):
+    def __init__(self, dbname, address, q_name, skip_locked, top_bound):
+        super(Locker, self).__init__()
+        self.queue = Queue(q_name, top_bound, skip_locked)
+        self.queue.conn_adapter = ConnAdapter(connect(dbname, **address))
+        self.locked = 0
+
+    def run(self):
+        while True:
+            job = self.queue.lock()
+            if job is None:
+                break
+            self.queue.delete(job['id'])
+            self.locked += 1
+        self.queue.conn_adapter.disconnect()
+
+def bench(dbname, address, jobs, workers, skip_locked, top_bound):
+    queue = Queue('bench_lock')
+    queue.conn_adapter = ConnAdapter(connect(dbname, **address))
+    queue.delete_all()
+    queue.enqueue_many('bench.noop', ([i] for i in xrange(jobs)))
+    queue.conn_adapter.disconnect()
+    lockers = [Locker(dbname, address, 'bench_lock', skip_locked, top_bound)
+               for i in range(workers)]
+    t0 = time.time()
+    for locker in lockers:
+        locker.start()
+    for locker in lockers:
+        locker.join()
+    elapsed = time.time() - t0
+    assert sum(locker.locked for locker in lockers) == jobs
+    return jobs / elapsed
+
+parser = argparse.ArgumentParser(add_help=False)
+parser.add_argument('--help', action='store_true')
+parser.add_argument('--host', '-h', default='localhost')
+parser.add_argument('--port', '-p', type=int, default=5432)
+parser.add_argument('--username', '-U', default=os.environ.get('USER'))
+parser.add_argument('--jobs', type=int, default=5000)
+parser.add_argument('--top-bound', type=int, default=9)
+parser.add_argument('--workers', type=int, nargs='+', default=[1, 10, 50])
+
+def main(args):
+    if args.help:
+        parser.print_help()
+        return
+    address = dict(host=args.host, port=args.port, username=args.username)
+    with temporary_database('bench_pueuey', **address) as dbname:
+        print "%8s %20s %20s" % ('workers', 'lock_head (jobs/s)',
+                                 'skip_locked (jobs/s)')
+        for workers in args.workers:
+            results = [bench(dbname, address, args.jobs, workers,
+                             skip_locked, args.top_bound)
+                       for skip_locked in (False, True)]
+            print "%8d %20.1f %20.1f" % tuple([workers] + results)
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+
+# Measures the cost of the serializers of the args of the jobs for payloads
+# from 100 B to 1 MB: the time spent encoding and decoding in the client
+# alone, then the time per job of an enqueue followed by a lock (which
+# includes the transfer and, for the JSON serializers, the validation of
+# the json column by the server). A temporary database is created using
+# createdb/dropdb, as for the tests.
+
+import argparse
+import os
+import time
+
+from pueuey import ConnAdapter, Queue, serializers
+from common import connect, temporary_database
+
+
+SIZES = [100, 1000, 10 * 1000, 100 * 1000, 1000 * 1000]
+
+# Returns args of about size bytes once encoded in JSON: a list of records
+# mixing strings, integers, floats and booleans.
+def payload(size):
+    record = {'name': 'x' * 20, 'count': 123456, 'ratio': 0.25,
+              'active': True}
+    return [dict(record, id=i) for i in xrange(max(1, size // 80))]
+
+def measure(func, calls):
+    t0 = time.time()
+    for i in xrange(calls):
+        func()
+    return (time.time() - t0) / calls * 1e6
+
+def bench(dbname, address, name, args, calls):
+    serializer = serializers.get(name)
+    data = serializer.dumps(args)
+    encode = measure(lambda: serializer.dumps(args), calls)
+    decode = measure(lambda: serializer.loads(data), calls)
+    queue = Queue('bench_serializers', top_bound=1, serializer=serializer)
+    queue.conn_adapter = ConnAdapter(connect(dbname, **address))
+
+    def round_trip():
+        queue.enqueue('bench.noop', args)
+        queue.delete(queue.lock()['id'])
+
+    trip = measure(round_trip, calls)
+    queue.conn_adapter.disconnect()
+    return len(data), encode, decode, trip
+
+parser = argparse.ArgumentParser(add_help=False)
+parser.add_argument('--help', action='store_true')
+parser.add_argument('--host', '-h', default='localhost')
+parser.add_argument('--port', '-p', type=int, default=5432)
+parser.add_argument('--username', '-U', default=os.environ.get('USER'))
+parser.add_argument('--calls', type=int, default=200)
+
+def main(args):
+    if args.help:
+        parser.print_help()
+        return
+    names = ['json', 'raw:json']
+    if serializers.ujson is not None:
+        names += ['ujson', 'raw:ujson']
+    if serializers.msgpack is not None:
+        names += ['msgpack', 'raw:msgpack']
+    address = dict(host=args.host, port=args.port, username=args.username)
+    with temporary_database('bench_pueuey', **address) as dbname:
+        print "%8s %12s %10s %14s %14s %14s" % (
+            'size', 'serializer', 'encoded', 'encode (us)', 'decode (us)',
+            'job (us)')
+        for size in SIZES:
+            # fewer calls for the large payloads
+            calls = max(5, args.calls * 1000 // size)
+            for name in names:
+                print "%8d %12s %10d %14.1f %14.1f %14.1f" % (
+                    (size, name) +
+                    bench(dbname, address, name, payload(size), calls))
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -3,6 +3,7 @@ import io
 import threading
 import subprocess
 from time import sleep
+from contextlib import contextmanager
 import psycopg2
 import unittest2
 
@@ -26,6 +27,20 @@ def connect(dbname, host=None, port=None, username=None, cursor_factory=None):
     return psycopg2.connect(database=dbname,
         host=host, port=port, user=username, cursor_factory=cursor_factory)
 
+# Creates a database with the tables and functions of pueuey and yields its
+# name, the database is dropped afterwards. Used by the benchmarks.
+@contextmanager
+def temporary_database(basename, **address):
+    dbname = "%s_%d" % (basename, os.getpid())
+    run('createdb', dbname, **address)
+    try:
+        conn = connect(dbname, **address)
+        setup.create(conn)
+        conn.close()
+        yield dbname
+    finally:
+        run('dropdb', dbname, **address)
+
 class Notifier(threading.Thread):
     def __init__(self, connection, chan, delay):
         super(Notifier, self).__init__()
@@ -48,6 +48,8 @@ parser.add_argument('--username', '-U',
 parser.add_argument('--port', '-p', type=int)
 parser.add_argument('--queue', default='example_worker')
 parser.add_argument('--forkworker', action='store_true', default=None)
+parser.add_argument('--processes', type=int)
+parser.add_argument('--max-jobs', dest='max_jobs', type=int)
 parser.add_argument('--debug', action='store_true')
 parser.add_argument('working_directory', nargs='?',
     help="Working directory to monitor the events (required)")
@@ -72,7 +74,8 @@ def run(args):
         signal.signal(signal.SIGQUIT, lambda *a: os.kill(0, signal.SIGQUIT))
 
     worker = MyWorker(args.working_directory,
-        connection=conn, q_name=args.queue, fork_worker=args.forkworker)
+        connection=conn, q_name=args.queue, fork_worker=args.forkworker,
+        processes=args.processes, max_jobs=args.max_jobs)
     try:
         worker.start()
     except OSError, exc:
@@ -36,3 +36,34 @@ class ConnTest(ConnBaseTest):
         got = conn_adapter.wait(0.1, 'something')
         self.assertIsNone(got)
         notifier.join()
+
+    def test_55_notify_between_waits(self):
+        conn_adapter = ConnAdapter(self.conn)
+        self.assertIsNone(conn_adapter.wait(0.1, 'test_chan'))
+        notifier = Notifier(self._connect(), 'test_chan', 0)
+        notifier.start()
+        notifier.join()
+        got = conn_adapter.wait(1, 'test_chan')
+        self.assertIsNotNone(got)
+        self.assertEqual(got.channel, 'test_chan')
+        self.assertIsNone(conn_adapter.wait(0, 'test_chan'))
+
+    def test_57_notify_on_other_channel(self):
+        conn_adapter = ConnAdapter(self.conn)
+        self.assertIsNone(conn_adapter.wait(0, 'something_else'))
+        notifier = Notifier(self._connect(), 'something_else', 0)
+        notifier.start()
+        notifier.join()
+        self.assertIsNone(conn_adapter.wait(0.1, 'test_chan'))
+        got = conn_adapter.wait(1, 'something_else')
+        self.assertIsNotNone(got)
+        self.assertEqual(got.channel, 'something_else')
+
+    def test_60_unlisten(self):
+        conn_adapter = ConnAdapter(self.conn)
+        subscription = conn_adapter.subscribe('test_chan')
+        subscription.unlisten('test_chan')
+        notifier = Notifier(self._connect(), 'test_chan', 0)
+        notifier.start()
+        notifier.join()
+        self.assertIsNone(subscription.wait(0.1))
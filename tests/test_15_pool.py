@@ -0,0 +1,113 @@
+import os
+import threading
+import psycopg2
+import psycopg2.pool
+
+from pueuey import PooledConnAdapter, Queue
+from common import ConnBaseTest
+
+__all__ = ['PoolTest']
+
+
+class PoolTest(ConnBaseTest):
+    queues = 20
+
+    def _pool(self, **kwargs):
+        pool = PooledConnAdapter(connect=self._connect, **kwargs)
+        self.addCleanup(pool.disconnect)
+        return pool
+
+    def test_10_lazy(self):
+        pool = self._pool(max_idle=1, maxconn=2)
+        self.assertEqual(pool.idle, [])
+        with pool.checkout_connection() as conn:
+            self.assertEqual(pool.used, 1)
+        self.assertEqual(pool.used, 0)
+        self.assertEqual([c for c, since in pool.idle], [conn])
+        with pool.checkout_connection() as conn:
+            with pool.checkout_connection() as other:
+                self.assertEqual(pool.used, 2)
+        self.assertEqual([c for c, since in pool.idle], [other])
+        self.assertTrue(conn.closed)
+
+    def test_15_minconn(self):
+        pool = self._pool(minconn=2, maxconn=3)
+        self.assertEqual(pool.max_idle, 3)
+        self.assertEqual(len(pool.idle), 2)
+        with pool.checkout_connection() as conn:
+            with pool.checkout_connection() as other:
+                with pool.checkout_connection():
+                    self.assertEqual(pool.idle, [])
+        self.assertEqual(len(pool.idle), 3)
+        self.assertFalse(conn.closed or other.closed)
+        self.assertRaises(ValueError, PooledConnAdapter,
+                          minconn=2, max_idle=1)
+
+    def test_20_shared_by_queues(self):
+        pool = self._pool(max_idle=1, maxconn=1)
+        queues = []
+        for i in range(self.queues):
+            queue = Queue("queue_%03d" % i)
+            queue.conn_adapter = pool
+            queue.enqueue('Kernel.puts', [i])
+            queues.append(queue)
+        for i, queue in enumerate(queues):
+            self.assertEqual(queue.lock()['args'], [i])
+        self.assertEqual(len(pool.idle), 1)
+
+    def test_30_exhausted(self):
+        pool = self._pool(maxconn=1, timeout=0.1)
+        with pool.checkout_connection():
+            self.assertRaises(psycopg2.pool.PoolError, pool.checkout)
+
+    def test_40_threads(self):
+        pool = self._pool(max_idle=2, maxconn=2)
+        queue = Queue(self.q_name)
+        queue.conn_adapter = pool
+        threads = [threading.Thread(target=queue.enqueue,
+                                    args=('Kernel.puts', [i]))
+                   for i in range(self.queues)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.queue.count(), self.queues)
+        self.assertLessEqual(len(pool.idle), 2)
+
+    def test_50_broken_connection(self):
+        pool = self._pool(check_interval=0)
+        with pool.checkout_connection() as conn:
+            pass
+        conn.close()
+        with pool.checkout_connection() as other:
+            self.assertIsNot(other, conn)
+            self.assertFalse(other.closed)
+
+    def test_60_fork(self):
+        pool = self._pool()
+        with pool.checkout_connection() as conn:
+            pass
+        pid = os.fork()
+        if pid == 0:
+            try:
+                with pool.checkout_connection() as other:
+                    os._exit(0 if other is not conn else 1)
+            except:
+                os._exit(2)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        with pool.checkout_connection() as again:
+            self.assertIs(again, conn)
+
+    def test_70_table_lookup(self):
+        # a fresh Queue looks its table up on the connection it holds
+        pool = self._pool(maxconn=1, timeout=5)
+        def fresh():
+            queue = Queue(self.q_name)
+            queue.conn_adapter = pool
+            return queue
+        self.assertEqual(fresh().count(), 0)
+        self.queue.enqueue('Kernel.puts', [1])
+        id = fresh().lock()['id']
+        fresh().unlock(id)
+        self.assertEqual(fresh().lock()['id'], id)
+        self.assertEqual(pool.used, 0)
@@ -1,10 +1,15 @@
 import os
+import shutil
+import tempfile
 import threading
 import psycopg2
 import psycopg2.extras
 import unittest2
 
-from pueuey import Queue, ConnAdapter
+from pueuey import Queue, ConnAdapter, setup
+from pueuey.queue import Job, LoggingJobCursor, AdaptiveTopBound
+from pueuey.metrics import MemoryMetrics
+from pueuey import serializers, payloads
 from common import Notifier, ConnBaseTest
 
 
@@ -72,6 +77,90 @@ class QueueTest(ConnBaseTest):
             self.assertEqual(got['args'], job['args'])
             self.queue.delete(got['id'])
 
+    def test_21_dedicated_table(self):
+        other = Queue('other')
+        other.conn_adapter = self.queue.conn_adapter
+        moved = self.queue.enqueue('Kernel.puts', ['moved'])
+        other.enqueue('Kernel.puts', ['stays'])
+        table = setup.dedicate(self.queue.name, self.conn)
+        self.assertEqual(setup.dedicate(self.queue.name, self.conn), table)
+        self.assertEqual(self.queue.table, '"queue_classic_jobs"')
+        self.queue = Queue(self.queue.name)
+        self.queue.conn_adapter = other.conn_adapter
+        self.assertEqual(self.queue.table, '"%s"' % table)
+        id = self.queue.enqueue('Kernel.puts', ['new'])
+        with self.conn.cursor() as curs:
+            curs.execute('SELECT id FROM ONLY "%s" ORDER BY id' % table)
+            self.assertEqual([row['id'] for row in curs], [moved, id])
+            curs.execute('SELECT count(*) FROM queue_classic_jobs')
+            self.assertEqual(curs.fetchone()['count'], 3)
+        self.conn.commit()
+        self.assertEqual(self.queue.count(), 2)
+        self.assertEqual(other.count(), 1)
+        got = self.queue.lock(top_bound=1)
+        self.assertEqual(got['id'], moved)
+        self.assertEqual(self.queue.lock(top_bound=1)['id'], id)
+        self.queue.delete(moved)
+        self.assertEqual(self.queue.count(), 1)
+        self.assertEqual(other.lock(top_bound=1)['args'], ['stays'])
+
+    def test_21_dedicated_table_routing(self):
+        stale = Queue(self.queue.name)
+        stale.conn_adapter = self.queue.conn_adapter
+        self.assertEqual(stale.table, '"queue_classic_jobs"')
+        table = setup.dedicate(self.queue.name, self.conn)
+        ids = [stale.enqueue('Kernel.puts', ['single'])]
+        ids += stale.enqueue_many('Kernel.puts', [['batch']])
+        self.assertEqual(stale.table, '"%s"' % table)
+        with self.conn.cursor() as curs:
+            curs.execute('SELECT id FROM ONLY "%s" ORDER BY id' % table)
+            self.assertEqual([row['id'] for row in curs], ids)
+            curs.execute('SELECT count(*) FROM ONLY queue_classic_jobs')
+            self.assertEqual(curs.fetchone()['count'], 0)
+        self.conn.commit()
+        # resolved on the application's connection, not through the adapter
+        conn = self._connect()
+        queue = Queue(self.queue.name)
+        queue.conn_adapter = None
+        ids.append(queue.enqueue('Kernel.puts', ['caller'], connection=conn))
+        self.assertEqual(queue.table, '"%s"' % table)
+        conn.commit()
+        for id in ids:
+            self.assertEqual(self.queue.lock(top_bound=1)['id'], id)
+
+    def test_22_enqueue_many(self):
+        args = (["test_args_%03d" % i] for i in range(self.tries))
+        ids = self.queue.enqueue_many('Kernel.puts', args, chunk_size=7)
+        self.assertEqual(len(ids), self.tries)
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(self.queue.count(), self.tries)
+        for i in range(self.tries):
+            got = self.queue.lock(top_bound=1)
+            self.assertIsNotNone(got)
+            self.assertEqual(got['id'], ids[i])
+            self.assertEqual(got['args'], ["test_args_%03d" % i])
+            self.queue.delete(got['id'])
+
+    def test_23_enqueue_batch_mixed_methods(self):
+        jobs = [('test_method_%03d' % i, [i]) for i in range(self.tries)]
+        ids = self.queue.enqueue_batch(jobs)
+        self.assertEqual(len(ids), self.tries)
+        for i in range(self.tries):
+            got = self.queue.lock(top_bound=1)
+            self.assertEqual(got['id'], ids[i])
+            self.assertEqual((got['method'], got['args']), jobs[i])
+            self.queue.delete(got['id'])
+
+    def test_24_lock_fallback(self):
+        for skip_locked in (True, False):
+            ids = self.queue.enqueue_many('Kernel.puts', [[1], [2], [3]])
+            for id in ids:
+                got = self.queue.lock(top_bound=1, skip_locked=skip_locked)
+                self.assertIsNotNone(got)
+                self.assertEqual(got['id'], id)
+                self.queue.delete(got['id'])
+            self.assertIsNone(self.queue.lock(skip_locked=skip_locked))
+
     def test_25_main_queue_multiple_connections(self):
         queues = []
         for i in range(self.queues):
@@ -100,6 +189,74 @@ class QueueTest(ConnBaseTest):
             except ValueError:
                 self.fail("can't remove item %s from the stack" % repr(got))
 
+    def test_26_lock_many(self):
+        ids = self.queue.enqueue_many('Kernel.puts', ([i] for i in range(10)))
+        jobs = self.queue.lock_many(4)
+        self.assertEqual([job['id'] for job in jobs], ids[:4])
+        self.queue.unlock_many([job['id'] for job in jobs[2:]])
+        jobs = self.queue.lock_many(20)
+        self.assertEqual([job['id'] for job in jobs], ids[2:])
+        self.assertEqual(self.queue.lock_many(20), [])
+
+    def test_27_enqueue_in_transaction(self):
+        listener = ConnAdapter(self._connect())
+        listener.subscribe(self.queue.name)
+        conn = self._connect()
+        self.queue.enqueue('Kernel.puts', [1], connection=conn.cursor())
+        self.queue.enqueue_many('Kernel.puts', [[2], [3]], connection=conn)
+        self.assertEqual(self.queue.count(), 0)
+        self.assertIsNone(listener.wait(0.1, self.queue.name))
+        conn.rollback()
+        self.assertEqual(self.queue.count(), 0)
+        self.queue.enqueue_many('Kernel.puts', [[2], [3]], connection=conn)
+        self.assertFalse(conn.autocommit)
+        conn.commit()
+        self.assertEqual(self.queue.count(), 2)
+        self.assertIsNotNone(listener.wait(0.1, self.queue.name))
+        self.assertIsNone(listener.wait(0.1, self.queue.name))
+
+    def test_28_prepared_statements(self):
+        for prepare in (True, False):
+            self.queue.conn_adapter = ConnAdapter(self._connect(),
+                                                  prepare=prepare)
+            ids = [self.queue.enqueue('Kernel.puts', [i]) for i in range(3)]
+            got = self.queue.lock(top_bound=1)
+            self.assertEqual(got['id'], ids[0])
+            self.queue.unlock(got['id'])
+            self.queue.delete(ids[0])
+            self.queue.delete_many(ids[1:])
+            self.assertEqual(self.queue.count(), 0)
+        # a pooler which does not keep the sessions loses the statements
+        self.queue.conn_adapter = ConnAdapter(self._connect(), prepare=True)
+        self.queue.delete(self.queue.enqueue('Kernel.puts', []))
+        self.queue.conn_adapter.execute('DEALLOCATE ALL')
+        id = self.queue.enqueue('Kernel.puts', [])
+        self.queue.delete(id)
+        self.assertEqual(self.queue.count(), 0)
+
+    def test_29_time_to_lock(self):
+        self.queue.metrics = MemoryMetrics()
+        ids = [self.queue.enqueue('Kernel.puts', []) for i in range(2)]
+        with self.conn.cursor() as curs:
+            curs.execute('UPDATE queue_classic_jobs '
+                         "SET created_at = now() - interval '3.2 seconds', "
+                         "run_at = now() - interval '3.2 seconds' "
+                         'WHERE id = %s', ids[:1])
+            # the time spent waiting for its run_at is not counted
+            curs.execute('UPDATE queue_classic_jobs '
+                         "SET created_at = now() - interval '1 day', "
+                         "run_at = now() - interval '3.2 seconds' "
+                         'WHERE id = %s', ids[1:])
+        self.conn.commit()
+        self.queue.lock()
+        self.queue.lock()
+        timings = self.queue.metrics.timings[
+            'qc.time-to-lock', (('source', self.queue.name),)]
+        self.assertEqual(len(timings), 2)
+        for timing in timings:
+            self.assertGreaterEqual(timing, 3.2)
+            self.assertLess(timing, 10)
+
     def test_30_multiple_queue_multiple_connections(self):
         queues = []
         for i in range(self.queues):
@@ -125,6 +282,83 @@ class QueueTest(ConnBaseTest):
             except ValueError:
                 self.fail("can't remove item %s in stack" % got)
 
+    def test_31_lock_first(self):
+        queues = [Queue("queue_%03d" % i) for i in range(3)]
+        for queue in queues:
+            queue.conn_adapter = self.queue.conn_adapter
+        self.assertEqual(Queue.lock_first(queues), [])
+        low = queues[2].enqueue('Kernel.puts', ['low'])
+        high = queues[1].enqueue_many('Kernel.puts', [['high']] * 3)
+        got = Queue.lock_first(queues, 2)
+        self.assertEqual([(queue, job['id']) for queue, job in got],
+                         [(queues[1], high[0]), (queues[1], high[1])])
+        [(queue, job)] = Queue.lock_first(queues)
+        self.assertEqual((queue, job['id']), (queues[1], high[2]))
+        [(queue, job)] = Queue.lock_first(queues, 2)
+        self.assertEqual((queue, job['id']), (queues[2], low))
+
+    def test_32_priority_and_run_at(self):
+        low = self.queue.enqueue('Kernel.puts', ['low'], priority=10)
+        later = self.queue.enqueue('Kernel.puts', ['later'], run_at=3600)
+        high = self.queue.enqueue_many('Kernel.puts', [['high']] * 2,
+                                       priority=-1)
+        self.assertEqual([self.queue.lock(top_bound=1)['id']
+                          for i in range(3)], high + [low])
+        self.assertIsNone(self.queue.lock(top_bound=1))
+        due_in = Queue.due_in([self.queue])
+        self.assertGreater(due_in, 3590)
+        self.assertLessEqual(due_in, 3600)
+        with self.conn.cursor() as curs:
+            curs.execute("UPDATE queue_classic_jobs "
+                         "SET run_at = now() - interval '1 second' "
+                         "WHERE id = %s", [later])
+        self.conn.commit()
+        self.assertEqual(Queue.due_in([self.queue]), 0)
+        self.assertEqual(self.queue.lock()['id'], later)
+        self.assertIsNone(Queue.due_in([self.queue]))
+
+    def test_33_stats(self):
+        other = Queue('other')
+        other.conn_adapter = self.queue.conn_adapter
+        self.queue.enqueue_many('Kernel.puts', [[i] for i in range(100)])
+        self.queue.enqueue('Kernel.puts', ['later'], run_at=3600)
+        other.enqueue('Kernel.puts', [])
+        self.queue.lock_many(3)
+        self.assertEqual(self.queue.stats(exact=True),
+                         {'ready': 97, 'locked': 3, 'total': 101})
+        self.assertEqual(self.queue.stats(exact=True, all_queues=True), {
+            self.queue.name: {'ready': 97, 'locked': 3, 'total': 101},
+            'other': {'ready': 1, 'locked': 0, 'total': 1},
+        })
+        with self.conn.cursor() as curs:
+            curs.execute('ANALYZE queue_classic_jobs')
+        self.conn.commit()
+        stats = self.queue.stats()
+        self.assertEqual(stats['locked'], 3)
+        self.assertAlmostEqual(stats['ready'], 97, delta=10)
+        self.assertAlmostEqual(stats['total'], 101, delta=10)
+
+    def test_34_serializers(self):
+        names = ['json', 'raw:json']
+        if serializers.ujson is not None:
+            names += ['ujson', 'raw:ujson']
+        if serializers.msgpack is not None:
+            names += ['msgpack', 'raw:msgpack']
+        args = [{'text': u'caf\xe9', 'list': [1, 2.5, None, True]}]
+        for name in names:
+            serializer = serializers.get(name)
+            queue = Queue(self.queue.name, serializer=serializer)
+            queue.conn_adapter = self.queue.conn_adapter
+            queue.enqueue('Kernel.puts', args)
+            queue.enqueue_many('Kernel.puts', [args])
+            for job in [queue.lock()] + queue.lock_many(2):
+                if serializer.raw:
+                    self.assertEqual(serializer.serializer.loads(
+                        str(job['args'])), args)
+                else:
+                    self.assertEqual(job['args'], args)
+                queue.delete(job['id'])
+
     def test_35_main_queue_concurrent(self):
         enqueuers = []
         lockers = []
@@ -157,6 +391,125 @@ class QueueTest(ConnBaseTest):
         self.assertEqual(len(stack), 0,
             "The stack of jobs should be empty after locked them all")
 
+    def test_36_external_payloads(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        args = ['x' * 1000]
+        for store in [payloads.TablePayloadStore(),
+                      payloads.FilePayloadStore(directory)]:
+            queue = Queue(self.queue.name, payload_threshold=100,
+                          payload_store=store)
+            queue.conn_adapter = self.queue.conn_adapter
+            id = queue.enqueue('Kernel.puts', args)
+            [small, large] = queue.enqueue_many('Kernel.puts', [[], args])
+            with self.conn.cursor() as curs:
+                curs.execute('SELECT id, args::text FROM queue_classic_jobs '
+                             'WHERE external ORDER BY id')
+                self.assertEqual(
+                    [(row['id'], row['args']) for row in curs.fetchall()],
+                    [(id, 'null'), (large, 'null')])
+            self.conn.commit()
+            job = queue.lock()
+            self.assertEqual((job['id'], job['args']), (id, args))
+            jobs = queue.lock_many(2)
+            self.assertEqual([job['args'] for job in jobs], [[], args])
+            queue.delete(id)
+            queue.delete_many([small, large])
+            with self.conn.cursor() as curs:
+                curs.execute('SELECT count(*) FROM queue_classic_payloads')
+                self.assertEqual(curs.fetchone()['count'], 0)
+            self.conn.commit()
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_36_external_payloads_rollback(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        args = ['x' * 1000]
+        class FailingStore(payloads.FilePayloadStore):
+            puts = 0
+            def put(self, curs, id, payload):
+                self.puts += 1
+                if self.puts == 2:
+                    raise IOError("disk full")
+                super(FailingStore, self).put(curs, id, payload)
+        # an application's connection in autocommit mode
+        conn = self._connect()
+        conn.autocommit = True
+        queue = Queue(self.queue.name, payload_threshold=100,
+                      payload_store=FailingStore(directory))
+        queue.conn_adapter = self.queue.conn_adapter
+        self.assertRaises(IOError, queue.enqueue_many, 'Kernel.puts',
+                          [args, args], connection=conn)
+        self.assertEqual(queue.count(), 0)
+        self.assertEqual(os.listdir(directory), [])
+        # a transaction of the application rolled back
+        store = payloads.FilePayloadStore(directory)
+        queue = Queue(self.queue.name, payload_threshold=100,
+                      payload_store=store)
+        queue.conn_adapter = self.queue.conn_adapter
+        id = queue.enqueue('Kernel.puts', args)
+        conn = self._connect()
+        queue.enqueue('Kernel.puts', args, connection=conn)
+        conn.rollback()
+        self.assertEqual(len(os.listdir(directory)), 2)
+        with self.conn.cursor(
+                cursor_factory=psycopg2.extensions.cursor) as curs:
+            self.assertEqual(store.sweep(curs), 0)
+            self.assertEqual(store.sweep(curs, age=0), 1)
+        self.conn.commit()
+        self.assertEqual(os.listdir(directory), ['%d.payload' % id])
+
+    def test_37_job(self):
+        id = self.queue.enqueue('Kernel.puts', ['hello'])
+        job = self.queue.lock()
+        self.assertIsInstance(job, Job)
+        self.assertEqual((job.id, job.q_name, job.method, job.args),
+                         (id, self.queue.name, 'Kernel.puts', ['hello']))
+        self.assertEqual(job['args'], job.args)
+        self.assertIsNotNone(job.created_at)
+        self.assertRaises(KeyError, lambda: job['locked_at'])
+        self.assertRaises(AttributeError, setattr, job, 'data', None)
+        adapter = self.queue.conn_adapter
+        with adapter.cursor(LoggingJobCursor, reuse=True) as curs:
+            pass
+        self.assertIsNone(self.queue.lock())
+        with adapter.cursor(LoggingJobCursor, reuse=True) as reused:
+            self.assertIs(reused, curs)
+            self.assertFalse(reused.closed)
+
+    def test_38_adaptive_top_bound(self):
+        bound = AdaptiveTopBound(maximum=16, window=10)
+        for i in range(50):
+            bound.observe(0.001)
+        self.assertEqual(int(bound), 1)
+        for i in range(50):
+            bound.observe(0.01)
+        self.assertEqual(int(bound), 16)
+        for i in range(1000):
+            bound.observe(0.001)
+        self.assertEqual(int(bound), 1)
+        bound.workers = 4
+        self.assertEqual(int(bound), 4)
+
+        queue = Queue(self.queue.name, top_bound='auto', skip_locked=False,
+                      metrics=MemoryMetrics())
+        queue.conn_adapter = self.queue.conn_adapter
+        queue.top_bound.window = 5
+        queue.enqueue_many('Kernel.puts', [[i] for i in range(5)])
+        for i in range(5):
+            self.assertIsNotNone(queue.lock())
+        self.assertEqual(queue.metrics.gauges[
+            'qc.top-bound', (('source', queue.name),)], int(queue.top_bound))
+
+    def test_39_scheduled_priorities(self):
+        self.queue.enqueue_many('Kernel.puts', [[i] for i in range(100)],
+                                run_at=3600)
+        due = self.queue.enqueue_many('Kernel.puts', [[], []], priority=5)
+        self.assertEqual(self.queue.lock(skip_locked=False)['id'], due[0])
+        self.assertEqual(self.queue.lock(skip_locked=True)['id'], due[1])
+        self.assertIsNone(self.queue.lock())
+        self.assertEqual(self.queue.lock_many(10), [])
+
     def test_40_multiple_queues_concurrent(self):
         queues = []
         stacks = {}
@@ -5,18 +5,28 @@ import tempfile
 import shutil
 import unittest2
 import subprocess
+import threading
+import psycopg2
 
 from pueuey import Queue, ConnAdapter, Worker
+from pueuey.metrics import MemoryMetrics
 from common import Notifier, ConnBaseTest
 import example_worker
 
 
 reg_args = None
+executed = []
 
 def register(*args):
     global reg_args
     reg_args = args
 
+def execute(i):
+    executed.append(i)
+
+def fail(*args):
+    raise ValueError(args)
+
 class WorkerTest(ConnBaseTest):
     q_name = 'test_worker'
     concurrent_workers = 10
@@ -35,11 +45,11 @@ class WorkerTest(ConnBaseTest):
         shutil.rmtree(self.working_directory)
         super(WorkerTest, self)._cleanup()
 
-    def _invoke_worker(self, fork=False):
+    def _invoke_worker(self, fork=False, extra_args=[]):
         p = subprocess.Popen(
             [example_worker.__file__, self.working_directory,
              '--dbname=' + self.dbname, '--queue=' + self.q_name] +
-            (['--forkworker'] if fork else []),
+            (['--forkworker'] if fork else []) + extra_args,
             preexec_fn=os.setpgrp)
         self.running_workers.append(p)
         return p
@@ -61,11 +71,159 @@ class WorkerTest(ConnBaseTest):
             self.assertEqual(reg_args, ("foo", "bar"))
             reg_args = None
 
+    def test_03_dispatch(self):
+        global reg_args
+        worker = Worker(connection=self._connect(), q_name=self.q_name,
+                        prewarm=["test_30_worker.register"])
+        worker.dispatcher.prewarm(worker.prewarm)
+        self.assertEqual(worker.dispatcher.stats()['misses'], 1)
+
+        @worker.task("register_twice")
+        def register_twice(*args):
+            register(*(args * 2))
+
+        self.queue.enqueue("test_30_worker.register", ["foo"])
+        self.queue.enqueue("register_twice", ["bar"])
+        worker.work()
+        self.assertEqual(reg_args, ("foo",))
+        worker.work()
+        self.assertEqual(reg_args, ("bar", "bar"))
+        reg_args = None
+        stats = worker.dispatcher.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+    def test_04_queue_weights(self):
+        worker = Worker(connection=self._connect(), q_names=['a', 'b'],
+                        weights=[1, 99])
+        firsts = [worker.ordered_queues()[0].name for i in range(1000)]
+        self.assertGreater(firsts.count('b'), firsts.count('a'))
+        self.assertGreater(firsts.count('a'), 0)
+        self.assertRaises(ValueError, Worker, connection=self.conn,
+                          q_names=['a', 'b'], weights=[1])
+
+    def test_05_prefetch(self):
+        worker = Worker(connection=self._connect(), q_name=self.q_name,
+                        prefetch=5)
+        self.queue.enqueue_many("test_30_worker.register",
+                                ([i] for i in range(8)))
+        for i in range(3):
+            worker.work()
+            self.assertEqual(reg_args, (i,))
+        self.assertEqual(len(worker.prefetched), 2)
+        worker.unlock_prefetched()
+        self.assertEqual(len(worker.prefetched), 0)
+        self.assertEqual(self.queue.count(), 5)
+        self.assertEqual(len(self.queue.lock_many(10)), 5)
+
+    def test_06_sleep_until_due(self):
+        worker = Worker(connection=self._connect(), q_name=self.q_name,
+                        wait_interval=5)
+        worker.conn_adapter.subscribe(self.q_name)
+        self.assertEqual(worker.wait_time(), 5)
+        self.queue.enqueue("test_30_worker.register", ["foo"], run_at=0.5)
+        # cached until the notification of the job is received by lock_job
+        self.assertEqual(worker.wait_time(), 5)
+        start = time.time()
+        queue, job = worker.lock_job()
+        self.assertEqual(job['args'], ["foo"])
+        self.assertLess(time.time() - start, 2)
+
+    def test_07_delete_batch(self):
+        worker = Worker(connection=self._connect(), q_name=self.q_name,
+                        delete_batch=3, delete_interval=60)
+        self.queue.enqueue_many("test_30_worker.register",
+                                ([i] for i in range(4)))
+        for count in (4, 4, 1, 1):
+            worker.work()
+            self.assertEqual(self.queue.count(), count)
+        worker.flush_completed()
+        self.assertEqual(self.queue.count(), 0)
+
+    def test_07_delete_batch_error(self):
+        worker = Worker(connection=self._connect(), q_name=self.q_name,
+                        delete_batch=2, delete_interval=60)
+        self.queue.enqueue_many("test_30_worker.register",
+                                ([i] for i in range(3)))
+        def delete_many(ids):
+            raise psycopg2.OperationalError("connection lost")
+        worker.queues[0].delete_many = delete_many
+        worker.work()
+        worker.work()
+        self.assertEqual(worker.completed_count, 2)
+        self.assertEqual(len(worker.failed), 0)
+        self.assertEqual(self.queue.count(), 3)
+        del worker.queues[0].delete_many
+        worker.work()
+        self.assertEqual(worker.completed_count, 0)
+        self.assertEqual(self.queue.count(), 0)
+
+    def test_08_metrics(self):
+        metrics = MemoryMetrics()
+        worker = Worker(connection=self._connect(), q_name=self.q_name,
+                        metrics=metrics)
+        self.queue.metrics = metrics
+        self.queue.enqueue_many("test_30_worker.register", [["foo"]])
+        self.queue.enqueue("test_30_worker.fail", ["bar"])
+        worker.work()
+        worker.work()
+        tags = (('source', self.q_name),)
+        self.assertEqual(metrics.counters['qc.enqueue', tags], 2)
+        self.assertEqual(metrics.counters['qc.lock', tags], 2)
+        self.assertEqual(metrics.counters['qc.job-error', tags], 1)
+        self.assertEqual(len(metrics.timings['qc.time-to-lock', tags]), 2)
+        self.assertEqual(len(metrics.timings['qc.time-to-process', tags]), 2)
+
+    def test_09_threads(self):
+        del executed[:]
+        connections = []
+        def connect():
+            connections.append(self._connect())
+            return connections[-1]
+        worker = Worker(connection=self._connect(), q_name=self.q_name,
+                        threads=4, wait_interval=1, connect=connect,
+                        heartbeat_interval=0)
+        self.queue.enqueue_many("test_30_worker.execute",
+                                ([i] for i in range(self.tasks)))
+        thread = threading.Thread(target=worker.start)
+        thread.start()
+        for i in range(10):
+            if len(executed) == self.tasks:
+                break
+            time.sleep(0.5)
+        worker.stop()
+        thread.join()
+        self.assertEqual(sorted(executed), range(self.tasks))
+        self.assertEqual(self.queue.count(), 0)
+        self.assertEqual(len(connections), 4)
+
     def test_10_one_worker_success(self):
         self._invoke_worker()
         self.queue.enqueue("example_worker.touch", ["foo"])
         self._check_exists("foo")
 
+    def test_11_retry_and_dead_letter(self):
+        worker = Worker(connection=self._connect(), q_name=self.q_name,
+                        max_attempts=2, retry_backoff=0)
+        id = self.queue.enqueue("test_30_worker.fail", ["bar"])
+        worker.work()
+        self.assertEqual(self.queue.count(), 1)
+        worker.work()
+        self.assertEqual(self.queue.count(), 0)
+        with self.conn.cursor() as curs:
+            curs.execute('SELECT id, attempts, last_error '
+                         'FROM queue_classic_failed_jobs')
+            self.assertEqual(curs.fetchall(),
+                             [(id, 2, repr(ValueError((u"bar",))))])
+        self.conn.commit()
+
+        worker = Worker(connection=self._connect(), q_name=self.q_name,
+                        max_attempts=2, retry_backoff=60)
+        self.queue.enqueue("test_30_worker.fail", ["bar"])
+        worker.work()
+        self.assertEqual(self.queue.count(), 1)
+        self.assertIsNone(self.queue.lock())
+        self.assertGreater(Queue.due_in([self.queue]), 50)
+
     @unittest2.expectedFailure
     def test_15_one_worker_failure(self):
         self._invoke_worker()
@@ -109,3 +267,13 @@ class WorkerTest(ConnBaseTest):
         for i in range(self.tasks):
             self._check_exists("job_%03d" % i, retry=5)
         self.assertEqual(self.queue.count(), 0)
+
+    def test_40_prefork_workers_recycled(self):
+        self._invoke_worker(extra_args=['--processes=%d'
+                                        % self.concurrent_workers,
+                                        '--max-jobs=3'])
+        for i in range(self.tasks):
+            self.queue.enqueue("example_worker.touch", ["job_%03d" % i])
+        for i in range(self.tasks):
+            self._check_exists("job_%03d" % i)
+        self.assertEqual(self.queue.count(), 0)
@@ -0,0 +1,49 @@
+import time
+import unittest2
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+from common import ConnBaseTest
+
+
+executed = []
+
+def execute(i, delay):
+    gevent.sleep(delay)
+    executed.append(i)
+
+@unittest2.skipIf(gevent is None, "gevent is not installed")
+class GreenWorkerTest(ConnBaseTest):
+    q_name = 'test_green_worker'
+    tasks = 100
+
+    def test_10_concurrent_jobs(self):
+        from pueuey import GreenWorker
+        del executed[:]
+        worker = GreenWorker(connection=self._connect(), q_name=self.q_name,
+                             concurrency=self.tasks, wait_interval=1)
+        self.queue.enqueue_many("test_40_green_worker.execute",
+                                ([i, 1] for i in range(self.tasks)))
+        greenlet = gevent.spawn(worker.start)
+        t0 = time.time()
+        while len(executed) < self.tasks and time.time() - t0 < 10:
+            gevent.sleep(0.1)
+        worker.stop()
+        greenlet.join()
+        self.assertEqual(sorted(executed), range(self.tasks))
+        # all the jobs sleep 1 second but they run concurrently
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual(self.queue.count(), 0)
+
+    def test_20_prewarm(self):
+        from pueuey import GreenWorker
+        worker = GreenWorker(connection=self._connect(), q_name=self.q_name,
+                             wait_interval=1, heartbeat_interval=0,
+                             prewarm=["test_40_green_worker.execute"])
+        worker.stop()
+        worker.start()
+        self.assertEqual(worker.dispatcher.stats()['misses'], 1)
+        self.assertEqual(worker.dispatcher.stats()['size'], 1)
@@ -0,0 +1,109 @@
+import time
+import psycopg2.extras
+
+from pueuey import Queue, ConnAdapter, Reaper, Worker
+from pueuey.metrics import MemoryMetrics
+from common import ConnBaseTest
+
+
+class ReaperTest(ConnBaseTest):
+    cursor_factory = psycopg2.extras.RealDictCursor
+
+    def _lock_elsewhere(self):
+        queue = Queue(self.queue.name)
+        queue.conn_adapter = ConnAdapter(self._connect())
+        id = self.queue.enqueue('Kernel.puts', [])
+        self.assertEqual(queue.lock(top_bound=1)['id'], id)
+        return queue, id
+
+    def _locked_at(self, id):
+        with self.conn.cursor() as curs:
+            curs.execute('SELECT locked_at FROM queue_classic_jobs '
+                         'WHERE id = %s', [id])
+            locked_at = curs.fetchone()['locked_at']
+        self.conn.commit()
+        return locked_at
+
+    def _register(self, queue):
+        pid = queue.conn_adapter.connection.get_backend_pid()
+        with self.conn.cursor() as curs:
+            curs.execute('SELECT queue_classic_heartbeat(%s, %s, %s, %s)',
+                         [pid, [queue.name], 'localhost', 0])
+        self.conn.commit()
+
+    def test_10_closed_connection(self):
+        queue, id = self._lock_elsewhere()
+        self._register(queue)
+        reaper = Reaper(self._connect(), metrics=MemoryMetrics())
+        self.assertEqual(reaper.reap(), 0)
+        queue.conn_adapter.disconnect()
+        for i in range(50):
+            if reaper.reap():
+                break
+            time.sleep(0.1)
+        self.assertIsNone(self._locked_at(id))
+        self.assertEqual(reaper.metrics.count('qc.reaped'), 1)
+
+    def test_15_unregistered_client(self):
+        queue, id = self._lock_elsewhere()
+        queue.conn_adapter.disconnect()
+        reaper = Reaper(self._connect())
+        time.sleep(0.5)
+        self.assertEqual(reaper.reap(), 0)
+        self.assertIsNotNone(self._locked_at(id))
+
+    def test_20_stale_worker(self):
+        queue, id = self._lock_elsewhere()
+        self._register(queue)
+        reaper = Reaper(self._connect(), stale=60)
+        self.assertEqual(reaper.reap(), 0)
+        with self.conn.cursor() as curs:
+            curs.execute("UPDATE queue_classic_workers "
+                         "SET heartbeat_at = now() - interval '2 minutes'")
+        self.conn.commit()
+        self.assertEqual(reaper.reap(), 1)
+        self.assertIsNone(self._locked_at(id))
+
+    def test_30_lock_timeout(self):
+        queue, id = self._lock_elsewhere()
+        reaper = Reaper(self._connect(), timeouts={self.queue.name: 60})
+        self.assertEqual(reaper.reap(), 0)
+        with self.conn.cursor() as curs:
+            curs.execute("UPDATE queue_classic_jobs "
+                         "SET locked_at = now() - interval '2 minutes'")
+        self.conn.commit()
+        self.assertEqual(reaper.reap(), 1)
+        self.assertEqual(queue.lock(top_bound=1)['id'], id)
+
+    def test_35_default_lock_timeout(self):
+        queue, id = self._lock_elsewhere()
+        queue.conn_adapter.disconnect()
+        reaper = Reaper(self._connect(), timeouts={self.queue.name: 86400})
+        with self.conn.cursor() as curs:
+            curs.execute("UPDATE queue_classic_jobs "
+                         "SET locked_at = now() - interval '2 hours'")
+        self.conn.commit()
+        self.assertEqual(reaper.reap(), 0)
+        reaper = Reaper(self._connect(), timeouts={})
+        self.assertEqual(reaper.timeout, 3600)
+        self.assertEqual(reaper.reap(), 1)
+        self.assertIsNone(self._locked_at(id))
+
+    def test_40_worker_heartbeat(self):
+        worker = Worker(connection=self._connect(), q_name=self.q_name,
+                        heartbeat_interval=0.1, reap_interval=0.1)
+        worker.start_heartbeat()
+        with self.conn.cursor() as curs:
+            curs.execute('SELECT * FROM queue_classic_workers')
+            [registered] = curs.fetchall()
+            self.assertEqual(
+                registered['pid'],
+                worker.conn_adapter.connection.get_backend_pid())
+            self.assertEqual(registered['q_names'], [self.q_name])
+        self.conn.commit()
+        time.sleep(0.3)
+        worker.stop_heartbeat()
+        with self.conn.cursor() as curs:
+            curs.execute('SELECT count(*) FROM queue_classic_workers')
+            self.assertEqual(curs.fetchone()['count'], 0)
+        self.conn.commit()